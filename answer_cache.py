@@ -0,0 +1,161 @@
+import os
+import re
+import json
+import time
+import logging
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+import numpy as np
+
+#numbers (12, 2019, 3.4) and capitalised words, the terms two similar questions can differ in
+#while asking about different things ("Article 12" and "Article 13", "Slovenia" and "Croatia")
+_KEY_TERM_RE = re.compile(r"\d+(?:[.,/-]\d+)*|\b[A-Z][\w-]*")
+
+
+class AnswerCache:
+    """
+    Disk-backed cache of LLM answers shared by every process that queries the same index.
+    Entries are scoped to an index version and the query parameters, and are found by
+    cosine similarity of the query embedding, so a rephrased question above `threshold`
+    reuses the stored answer if it names the same numbers and capitalised terms (the first
+    word of a question doesn't count). Lookups given the question texts only reuse the answer of the
+    same question (ignoring case and whitespace), for batches of questions that can be nearly
+    identical but ask about different things. Entries expire after `ttl_seconds`, and the least
+    recently used ones are evicted once there are more than `max_entries`.
+    """
+
+    def __init__(self, cache_path: str, threshold: float = 0.97,
+                 ttl_seconds: float = 7 * 24 * 3600, max_entries: int = 10000):
+        self.cache_path = cache_path
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY,
+                index_version TEXT NOT NULL,
+                params TEXT NOT NULL,
+                query_text TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_scope ON answers (index_version, params)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    @staticmethod
+    def _normalize_text(text: str) -> str:
+        return " ".join(text.lower().split())
+
+    #lower case numbers and capitalised words of a question, apart from its first word
+    @staticmethod
+    def _key_terms(text: str) -> frozenset:
+        matches = list(_KEY_TERM_RE.finditer(text.strip()))
+        if matches and matches[0].start() == 0 and not matches[0].group()[0].isdigit():
+            matches = matches[1:]
+        return frozenset(match.group().lower() for match in matches)
+
+    def _count(self, name: str, n: int) -> None:
+        if n:
+            self._conn.execute(
+                "INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                (name, n, n))
+
+    #returns the cached response for every query vector, None where there is no close enough entry
+    #with exact an entry is only reused for the same question text, not a similar one
+    #hits are marked with "cache_hit": True
+    def lookup_many(self, vectors, index_version: str, params: str, query_texts: List[str],
+                    exact: bool = False) -> List[Optional[Dict]]:
+        queries = self._normalize(vectors)
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, embedding, response, query_text FROM answers "
+                "WHERE index_version = ? AND params = ? AND created >= ? ORDER BY created",
+                (index_version, params, now - self.ttl_seconds)).fetchall()
+            if not rows:
+                self._count("misses", len(queries))
+                self._conn.commit()
+                return [None] * len(queries)
+
+            if exact:
+                #the newest entry of every question
+                by_text = {self._normalize_text(text): column for column, (_, _, _, text) in enumerate(rows)}
+                best = [by_text.get(self._normalize_text(text)) for text in query_texts]
+            else:
+                stored = np.stack([np.frombuffer(embedding, dtype=np.float32) for _, embedding, _, _ in rows])
+                similarities = queries @ stored.T
+                best = []
+                for row, text in enumerate(query_texts):
+                    #the most similar entry above the threshold that asks about the same things
+                    terms = self._key_terms(text)
+                    above = np.flatnonzero(similarities[row] >= self.threshold)
+                    above = above[np.argsort(-similarities[row, above], kind="stable")]
+                    best.append(next((int(column) for column in above
+                                      if self._key_terms(rows[column][3]) == terms), None))
+            responses, hit_ids = [], []
+            for column in best:
+                if column is not None:
+                    entry_id, _, response, _ = rows[column]
+                    responses.append({**json.loads(response), "cache_hit": True})
+                    hit_ids.append(entry_id)
+                else:
+                    responses.append(None)
+            self._conn.executemany("UPDATE answers SET last_used = ?, hits = hits + 1 WHERE id = ?",
+                                   [(now, entry_id) for entry_id in hit_ids])
+            self._count("hits", len(hit_ids))
+            self._count("misses", len(queries) - len(hit_ids))
+            self._conn.commit()
+        return responses
+
+    def lookup(self, vector, index_version: str, params: str, query_text: str) -> Optional[Dict]:
+        return self.lookup_many([vector], index_version, params, [query_text])[0]
+
+    def store(self, query_text: str, vector, index_version: str, params: str, response: Dict) -> None:
+        now = time.time()
+        embedding = self._normalize(vector)[0].tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answers (index_version, params, query_text, embedding, response, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (index_version, params, query_text, embedding, json.dumps(response), now, now))
+            self._evict(now)
+            self._conn.commit()
+
+    #drops expired entries, then the least recently used ones above max_entries
+    def _evict(self, now: float) -> None:
+        self._conn.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl_seconds,))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,))
+            self._count("evictions", count - self.max_entries)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM stats").fetchall())
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+        return {"hits": counters.get("hits", 0), "misses": counters.get("misses", 0),
+                "evictions": counters.get("evictions", 0), "entries": entries}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+        logging.info("Answer cache cleared")
@@ -1,8 +1,10 @@
+import asyncio
+import importlib
 import logging
 import os
 import time
-from main import main
 from populate_database import main as populate_main
+from result_store import ResultStore, question_id
 
 
 # Only log warnings
@@ -156,6 +158,12 @@ questions = [
     "Which authority appoints the Governor/President?"
 ]
 
+#every answer is saved here as it arrives, running again only asks the questions that have no answer yet
+RESULT_STORE = ResultStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "results.sqlite"))
+#times a failed question is asked before giving up until the next run
+MAX_ATTEMPTS = 3
+#seconds before the first retry, doubled for every further one
+RETRY_BACKOFF = 5.0
 
 
 def auto_run():
@@ -166,59 +174,99 @@ def auto_run():
         "max_context": 2500,
         "source_filter": None,
         "show_chunks": False,
+        # number of questions sent to the LLM at the same time
+        "max_concurrency": 4,
     }
 
+    #every folder gets its own shard in faiss/shards/<folder>, all built at the same time in worker processes
+    #--incremental only re-embeds the files that changed, so running again skips folders that are up to date
+    default_populate_args = [
+        "--incremental",
+        "--chunk-size", "900",
+        "--chunk-overlap", "50",
+        "--splitter-type", "token",
+        "--shards", ",".join(folders)
+    ]
+    try:
+        logging.info(f"Populating shards for folders: {folders}")
+        populate_main(cli_args=default_populate_args)
+    except Exception as e:
+        logging.error(f"Failed to populate shards: {e}")
+        return
+
+    query = importlib.import_module("query")
+    model = default_args["model"]
+    # answers depend on these, changing one of them asks every question again
+    params = f"k={default_args['num_chunks']};max_context={default_args['max_context']};source_filter={default_args['source_filter']}"
     for folder in folders:
         print(f"Starting processing for folder: {folder}")
-        #default argument for resetting the database
-        default_populate_args = [
-            "--reset",
-            "--chunk-size", "900",
-            "--chunk-overlap", "50",
-            "--splitter-type", "token",
-            "--folder-filter", folder
-        ]
+
+        # Modify the queries to include the country name
+        queries = [f"{base_query.replace('?', ' of the ' + folder + ' central bank?')}" for base_query in questions]
+        # Set output file name to country.txt
+        output_file = f"{folder}.txt"
         try:
-            logging.info(f"Populating database for folder: {folder}")
-            populate_main(cli_args=default_populate_args)
-            logging.info(f"Database populated successfully for folder: {folder}")
+            # answers stored for an older build of the shard are not reused
+            index_version = query.get_dbs(folder)[1]
         except Exception as e:
-            logging.error(f"Failed to populate database for folder {folder}: {e}")
-            continue  # Skip to the next folder if population fails
+            logging.error(f"Failed to load the index of folder {folder}: {e}")
+            continue
+        key = (folder, index_version, model, params)
 
-        # Process all questions for the current folder
-        for i, base_query in enumerate(questions, 1):
-            try:
-                # Modify the query to include the country name
-                query = f"{base_query.replace('?', ' of the ' + folder + ' central bank?')}"
-                # Set output file name to country.txt
-                output_file = f"{folder}.txt"
-                # Construct the list of arguments for each query
-                query_args = [
-                    "--query_text", query,
-                    "--num_chunks", str(default_args["num_chunks"]),
-                    "--model", default_args["model"],
-                    "--max_context", str(default_args["max_context"]),
-                ]
-                # calling main
-                result = main(cli_args=query_args)
+        # questions answered by an earlier (interrupted) run are skipped
+        done = RESULT_STORE.completed(*key)
+        pending = [i for i, query_text in enumerate(queries) if question_id(query_text) not in done]
+        if len(pending) < len(queries):
+            print(f"⏭️ Skipping {len(queries) - len(pending)} questions already answered for folder: {folder}")
 
-                # writing the response on a new line in the file
-                logging.info("Writing response to output file")
-                with open(output_file, "a", encoding="utf-8") as f:
-                    f.write(f"Question {i}:\n{query}\n\nResponse: {result['text']}\n")
-                    f.write("\nSources:\n")
-                    for j, source in enumerate(result['sources'], 1):
-                        # Extract filename from source path
-                        source_name = os.path.basename(source['source']) if source['source'] != "Unknown" else "Unknown"
-                        f.write(f"{j}. {source_name} (Page {source['page']})\n")
-                    f.write("\n")
-                print(f"Completed question {i} for folder: {folder}")
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            if not pending:
+                break
+            if attempt > 1:
+                delay = RETRY_BACKOFF * 2 ** (attempt - 2)
+                print(f"🔁 Retrying {len(pending)} failed questions for folder {folder} in {delay:.0f}s (attempt {attempt}/{MAX_ATTEMPTS})")
+                time.sleep(delay)
+
+            # every answer is saved as soon as it arrives, so an interruption loses nothing
+            def save_answer(j, response, batch=pending):
+                i = batch[j]
+                try:
+                    RESULT_STORE.record_success(*key, i + 1, queries[i], response)
+                    print(f"Completed question {i + 1} for folder: {folder}")
+                except Exception as e:
+                    logging.error(f"Error saving question {i + 1} for folder {folder}: {e}")
+
+            # all questions are embedded and searched in one go, then sent to the llm concurrently
+            try:
+                results = asyncio.run(query.query_rag_batch(
+                    [queries[i] for i in pending],
+                    k=default_args["num_chunks"],
+                    model_name=model,
+                    max_context_length=default_args["max_context"],
+                    source_filter=default_args["source_filter"],
+                    show_chunks=default_args["show_chunks"],
+                    max_concurrency=default_args["max_concurrency"],
+                    shard=folder,
+                    on_answer=save_answer,
+                ))
+                error = "no response"
             except Exception as e:
-                logging.error(f"Error processing question {i} for folder {folder}: {e}")
-                continue  # Continue with the next question
+                logging.error(f"Failed to run questions for folder {folder}: {e}")
+                results, error = [None] * len(pending), str(e)
+
+            failed = [i for i, result in zip(pending, results) if result is None]
+            for i in failed:
+                logging.error(f"No response for question {i + 1} for folder {folder}")
+                RESULT_STORE.record_failure(*key, i + 1, queries[i], error)
+            pending = failed
 
+        if pending:
+            logging.error(f"{len(pending)} questions for folder {folder} still failed after {MAX_ATTEMPTS} attempts, "
+                          f"run again to retry them")
+        # the report is written from the store, so it lists every answered question once, in order
+        answered = RESULT_STORE.export_txt(output_file, *key)
         logging.info(f"Finished processing all {len(questions)} questions for folder: {folder}")
+        print(f"📄 Wrote {answered}/{len(queries)} answers for folder {folder} to {output_file}")
 
 if __name__ == "__main__":
     start_time = time.time()
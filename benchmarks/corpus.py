@@ -0,0 +1,145 @@
+import os
+import csv
+import random
+import zipfile
+from xml.sax.saxutils import escape
+from typing import Dict, List
+
+#file formats the generator can write, all of them have a loader in populate_database.LOADER_MAPPING
+FORMATS = ["txt", "pdf", "docx", "csv"]
+#country codes used in the ISO2CODE_CBL_YEAR-MONTH file names
+COUNTRIES = ["SI", "AE", "DE", "FR", "JP", "BR", "KE", "NZ"]
+
+#words the articles are made of, including the statutory terms the questions ask about
+VOCABULARY = (
+    "the bank shall governor deputy board council quorum members meeting decision majority vote "
+    "appointment dismissal term office years president minister finance parliament government "
+    "inflation targeting price stability monetary policy exchange rate reserves liquidity lolr "
+    "lender last resort emergency assistance credit institutions supervision capital audit "
+    "annual report accounts profit loss transfer budget independence instruction prohibited "
+    "financing deficit securities open market operations interest rates mandate objective "
+    "amendment chapter article paragraph law act enacted entry into force repealed"
+).split()
+HEADINGS = ["General Provisions", "Objectives and Tasks", "Monetary Policy", "Governance",
+            "The Board", "Financial Provisions", "Supervision", "Final Provisions"]
+
+
+#one legislation-like page: a chapter heading followed by numbered articles
+def make_page(rng: random.Random, page: int, articles_per_page: int = 6, words_per_article: int = 70) -> str:
+    lines = [f"Chapter {page + 1}. {rng.choice(HEADINGS)}"]
+    for a in range(articles_per_page):
+        number = page * articles_per_page + a + 1
+        words = " ".join(rng.choice(VOCABULARY) for _ in range(words_per_article))
+        lines.append(f"Article {number}. {words.capitalize()}.")
+    return "\n\n".join(lines)
+
+
+def write_txt(path: str, pages: List[str]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(pages))
+
+
+#a minimal pdf with one text page per entry, Helvetica, enough for PyPDFLoader to extract
+def write_pdf(path: str, pages: List[str]) -> None:
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages)))}] /Count {len(pages)} >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, text in enumerate(pages):
+        text = text.replace("\\", "").replace("(", "").replace(")", "")
+        lines = [line[j:j + 95] for line in text.split("\n") for j in range(0, max(len(line), 1), 95)]
+        ops = "BT /F1 8 Tf 30 810 Td 10 TL " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objects.append(f"<< /Length {len(ops.encode('latin-1', 'replace'))} >>\nstream\n{ops}\nendstream")
+
+    out, offsets = b"%PDF-1.4\n", []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{obj}\nendobj\n".encode("latin-1", "replace")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+#a minimal docx (zip of word xml), one paragraph per article
+def write_docx(path: str, pages: List[str]) -> None:
+    paragraphs = "".join(
+        f"<w:p><w:r><w:t xml:space=\"preserve\">{escape(paragraph)}</w:t></w:r></w:p>"
+        for page in pages for paragraph in page.split("\n\n")
+    )
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f"<w:body>{paragraphs}</w:body></w:document>")
+    content_types = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                     '<Default Extension="xml" ContentType="application/xml"/>'
+                     '<Override PartName="/word/document.xml" ContentType="application/'
+                     'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>')
+    rels = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/officeDocument" Target="word/document.xml"/></Relationships>')
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", content_types)
+        z.writestr("_rels/.rels", rels)
+        z.writestr("word/document.xml", document)
+
+
+#a table of articles, one row each
+def write_csv(path: str, pages: List[str]) -> None:
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["chapter", "article", "text"])
+        for page_number, page in enumerate(pages, 1):
+            for paragraph in page.split("\n\n")[1:]:
+                number, _, text = paragraph.partition(". ")
+                writer.writerow([page_number, number, text])
+
+
+WRITERS = {"txt": write_txt, "pdf": write_pdf, "docx": write_docx, "csv": write_csv}
+
+
+#writes docs_per_format documents of every format into data_path/<folder>, spread over the countries
+#file names follow ISO2CODE_CBL_YEAR-MONTH like the real corpus. The same seed gives the same corpus.
+#returns {format: [paths]}
+def generate_corpus(data_path: str, folder: str, docs_per_format: int, pages_per_doc: int,
+                    formats: List[str] = FORMATS, seed: int = 0) -> Dict[str, List[str]]:
+    rng = random.Random(seed)
+    written = {}
+    for fmt in formats:
+        if fmt not in WRITERS:
+            raise ValueError(f"Unknown format: {fmt}")
+        written[fmt] = []
+        for i in range(docs_per_format):
+            country = COUNTRIES[i % len(COUNTRIES)]
+            # one file per country and year, like the real corpus
+            year, month = 1950 + i // len(COUNTRIES), 1 + i % 12
+            # populate_database only loads the files directly in the folder
+            directory = os.path.join(data_path, folder)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{country}_CBL_{year}-{month:02d}.{fmt}")
+            WRITERS[fmt](path, [make_page(rng, page) for page in range(pages_per_doc)])
+            written[fmt].append(path)
+    return written
+
+
+#questions in the style of the automated run, using words that are in the corpus
+def make_queries(num_queries: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed + 1)
+    templates = [
+        "Does the legislation require a quorum of {a} {b} for {c} decisions? (A) Yes (B) No / Not mentioned",
+        "Who is responsible for {a} {b} under Article {n}? (A) The Board (B) The Governor (C) Not mentioned",
+        "Is the central bank allowed to provide {a} {b} to the {c}? (A) Yes (B) No (C) Not mentioned",
+        "What does the law say about the {a} of the {b} {c}? (A) Specified (B) Not mentioned",
+    ]
+    return [
+        rng.choice(templates).format(a=rng.choice(VOCABULARY), b=rng.choice(VOCABULARY),
+                                     c=rng.choice(VOCABULARY), n=rng.randint(1, 60))
+        for _ in range(num_queries)
+    ]
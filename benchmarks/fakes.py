@@ -0,0 +1,164 @@
+import re
+import sys
+import json
+import time
+import types
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+#a word or punctuation mark with the whitespace before it, so decoding the tokens gives the text back
+_TOKEN_RE = re.compile(r"\s*(?:\w+|[^\w\s])|\s+")
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic stand-in for the sentence-transformers model: a hashed bag of words,
+    normalized, so texts sharing words are close. Costs a little CPU per text like a real encoder,
+    but needs no model download.
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in _WORD_RE.findall(text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+#installs a get_embedding_function module that returns FakeEmbeddings,
+#must run before populate_database or query is imported
+def install_fake_embeddings(dim: int = 384) -> None:
+    module = types.ModuleType("get_embedding_function")
+    module.MODEL_NAME = "benchmark-fake"
+    module.get_embedding_function = lambda cache=False, backend=None: FakeEmbeddings(dim)
+    module.embedding_backend = lambda: "torch"
+    module.check_onnx_recall = lambda texts: True
+    sys.modules["get_embedding_function"] = module
+
+
+#tiktoken downloads cl100k_base on first use. Without network (and no cached copy) the
+#tokens are approximated by words and punctuation, close enough for budgeting. Every distinct token
+#gets an id, so the token splitter can decode its windows back into text.
+#returns the name of the tokenizer in use
+def ensure_tokenizer() -> str:
+    try:
+        import tiktoken
+        tiktoken.get_encoding("cl100k_base")
+        return "cl100k_base"
+    except Exception:
+        pass
+
+    class _Approximate:
+        name = "approximate"
+
+        def __init__(self):
+            self._ids = {}
+            self._tokens = []
+            self._lock = threading.Lock()
+
+        def encode_ordinary(self, text):
+            tokens = _TOKEN_RE.findall(text)
+            with self._lock:
+                for token in tokens:
+                    if token not in self._ids:
+                        self._ids[token] = len(self._tokens)
+                        self._tokens.append(token)
+                return [self._ids[token] for token in tokens]
+
+        def encode_ordinary_batch(self, texts, num_threads=8):
+            return [self.encode_ordinary(text) for text in texts]
+
+        def encode(self, text, **kwargs):
+            return self.encode_ordinary(text)
+
+        def decode(self, tokens):
+            return "".join(self._tokens[token] for token in tokens)
+
+    encoding = _Approximate()
+    module = types.ModuleType("tiktoken")
+    module.get_encoding = lambda name: encoding
+    module.encoding_for_model = lambda name: encoding
+    sys.modules["tiktoken"] = module
+    return "approximate"
+
+
+class StubOllama:
+    """
+    Local HTTP server answering /api/generate like Ollama does, streaming a fixed answer.
+    prefill_ms_per_1k_tokens and ms_per_token simulate the model's speed, so prompt size still shows up
+    in the latency. Start it and point OLLAMA_HOST at .url.
+    """
+
+    ANSWER = ["(A)", " Yes", ".", " See", " Article", " 12", " of", " the", " law", "."]
+
+    def __init__(self, prefill_ms_per_1k_tokens: float = 20.0, ms_per_token: float = 2.0):
+        self.prefill_ms_per_1k_tokens = prefill_ms_per_1k_tokens
+        self.ms_per_token = ms_per_token
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stub.requests += 1
+                prompt_tokens = len(_WORD_RE.findall(body.get("prompt", "")))
+                prefill = prompt_tokens / 1000 * stub.prefill_ms_per_1k_tokens / 1000
+                time.sleep(prefill)
+                final = {"model": body.get("model"), "created_at": "2024-01-01T00:00:00Z", "response": "",
+                         "done": True, "done_reason": "stop",
+                         "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int(prefill * 1e9),
+                         "eval_count": len(stub.ANSWER),
+                         "eval_duration": int(len(stub.ANSWER) * stub.ms_per_token * 1e6),
+                         "load_duration": 0}
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                if not body.get("stream", True):
+                    data = json.dumps({**final, "response": "".join(stub.ANSWER)}).encode()
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for piece in stub.ANSWER:
+                    time.sleep(stub.ms_per_token / 1000)
+                    self._chunk({"model": body.get("model"), "created_at": "2024-01-01T00:00:00Z",
+                                 "response": piece, "done": False})
+                self._chunk(final)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, message):
+                data = (json.dumps(message) + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "StubOllama":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
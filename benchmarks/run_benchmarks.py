@@ -0,0 +1,350 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import sqlite3
+import random
+import argparse
+import importlib.util
+import platform
+import resource
+import tempfile
+import contextlib
+from datetime import datetime, timezone
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from corpus import FORMATS, WRITERS, generate_corpus, make_page, make_queries
+from fakes import StubOllama, ensure_tokenizer, install_fake_embeddings
+
+#the folder inside the temporary data directory the corpus is written to
+CORPUS_FOLDER = "benchmark"
+#after the incremental update every chunk must be among the hits of its own vector, at least this often
+#(below 1 only because hnsw search is approximate)
+MIN_SELF_RECALL = 0.99
+#hits of its own vector a chunk is looked for in
+SELF_RECALL_K = 10
+#packages the langchain loaders of these formats need, formats without them are skipped
+LOADER_DEPENDENCIES = {"pdf": "pypdf", "docx": "docx2txt"}
+#metrics compared by --compare, True where higher is better
+COMPARED_METRICS = {
+    ("ingest", "docs_per_second"): True,
+    ("ingest", "chunks_per_second"): True,
+    ("search", "p50_ms"): False,
+    ("search", "p95_ms"): False,
+    ("query", "p50_ms"): False,
+    ("query", "p95_ms"): False,
+    ("query", "p99_ms"): False,
+    ("query", "batch_queries_per_second"): True,
+    ("memory", "peak_rss_mb"): False,
+    ("ingest", "index_mb"): False,
+    ("ingest", "docstore_mb"): False,
+}
+
+
+#peak resident memory of this process and its finished worker processes, in MB
+#(ru_maxrss is in KB on linux and in bytes on macOS)
+def peak_rss_mb() -> float:
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / scale, 1)
+
+
+def latency_stats(seconds) -> dict:
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(ms):
+        return {"count": 0}
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+    }
+
+
+#collects the errors logged while populating, a file that fails to load or split still gives
+#numbers (unsplit pages count as chunks), but they must not end up in the results
+class ErrorLog(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+#populate_database arguments of the benchmark
+def populate_args(args) -> list:
+    cli_args = ["--chunk-size", str(args.chunk_size), "--chunk-overlap", str(args.chunk_overlap),
+                "--splitter-type", args.splitter_type, "--folder-filter", CORPUS_FOLDER,
+                "--loader-backend", args.loader_backend, "--index-type", args.index_type,
+                "--vector-codec", args.vector_codec]
+    if args.streaming:
+        cli_args.append("--streaming")
+    return cli_args
+
+
+#runs populate_database.main with cli_args, with its output captured unless verbose, returns the seconds
+#stops the benchmark if populating logged an error
+def run_populate(args, data_path: str, faiss_path: str, cli_args: list) -> float:
+    import populate_database
+
+    populate_database.DATA_PATH = data_path
+    populate_database.FAISS_PATH = faiss_path
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    error_log = ErrorLog()
+    logging.getLogger().addHandler(error_log)
+    start = time.perf_counter()
+    try:
+        with output:
+            populate_database.main(cli_args)
+    finally:
+        logging.getLogger().removeHandler(error_log)
+    seconds = time.perf_counter() - start
+    if error_log.messages:
+        print(f"\n❌ {len(error_log.messages)} errors were logged while populating, the results are not valid:")
+        for message in error_log.messages[:5]:
+            print(f"   {message}")
+        sys.exit(1)
+    return seconds
+
+
+#runs populate_database.main on the generated corpus
+def run_ingest(args, data_path: str, faiss_path: str, num_files: int) -> dict:
+    seconds = run_populate(args, data_path, faiss_path, populate_args(args))
+
+    docstore = os.path.join(faiss_path, "docstore.sqlite")
+    if not os.path.exists(docstore):
+        raise RuntimeError("populate_database did not write an index, run with --verbose to see why")
+    with contextlib.closing(sqlite3.connect(docstore)) as conn:
+        (chunks,) = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        (sources,) = conn.execute("SELECT COUNT(DISTINCT source) FROM chunks").fetchone()
+    return {
+        "seconds": round(seconds, 3),
+        "files": num_files,
+        "files_indexed": sources,
+        "chunks": chunks,
+        "docs_per_second": round(num_files / seconds, 2),
+        "chunks_per_second": round(chunks / seconds, 2),
+        # size on disk, which is also what the index and the chunks take in memory when queried
+        "index_mb": round(os.path.getsize(os.path.join(faiss_path, "faiss.index")) / 2 ** 20, 3),
+        "docstore_mb": round(os.path.getsize(docstore) / 2 ** 20, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+#removes one file of the corpus and rewrites another, updates the index with --incremental and checks
+#that the index still lines up with the docstore: every chunk's own vector has to find a chunk with its
+#text among its SELF_RECALL_K hits (a chunk whose index position was reused would find another's)
+def run_update_check(args, data_path: str, faiss_path: str, written: dict) -> dict:
+    from get_embedding_function import get_embedding_function
+    from index_manager import load_vectorstore
+
+    paths = [path for fmt in sorted(written) for path in written[fmt]]
+    os.remove(paths[0])
+    fmt = os.path.splitext(paths[-1])[1][1:]
+    rng = random.Random(args.seed + 2)
+    WRITERS[fmt](paths[-1], [make_page(rng, page) for page in range(args.pages)])
+    seconds = run_populate(args, data_path, faiss_path, populate_args(args) + ["--incremental"])
+
+    store = load_vectorstore(faiss_path, get_embedding_function(), mmap=False)
+    texts = {pos: store.docstore.search(doc_id).page_content for pos, doc_id in store.index_to_docstore_id.items()}
+    positions = sorted(texts)
+    vectors = np.asarray(store.embedding_function.embed_documents([texts[pos] for pos in positions]), dtype=np.float32)
+    _, hits = store.index.search(vectors, SELF_RECALL_K)
+    found = sum(texts[pos] in {texts.get(int(hit)) for hit in row} for pos, row in zip(positions, hits))
+    return {
+        "seconds": round(seconds, 3),
+        "chunks": len(positions),
+        "index_vectors": int(store.index.ntotal),
+        "self_recall": round(found / len(positions), 4) if positions else 0.0,
+    }
+
+
+#times retrieval alone, then full query_rag calls one after the other, then one query_rag_batch
+async def run_queries(args, queries) -> dict:
+    import query
+
+    db = query.get_db()
+    search_times = []
+    for text in queries:
+        start = time.perf_counter()
+        query.batch_similarity_search(db, [text], k=args.k, hybrid=not args.no_hybrid)
+        search_times.append(time.perf_counter() - start)
+
+    query_times, failures = [], 0
+    for text in queries:
+        start = time.perf_counter()
+        response = await query.query_rag(text, k=args.k, max_context_length=args.max_context,
+                                         use_cache=False, hybrid=not args.no_hybrid)
+        query_times.append(time.perf_counter() - start)
+        failures += response is None
+
+    start = time.perf_counter()
+    responses = await query.query_rag_batch(queries, k=args.k, max_context_length=args.max_context,
+                                            max_concurrency=args.concurrency, use_cache=False,
+                                            hybrid=not args.no_hybrid)
+    batch_seconds = time.perf_counter() - start
+    return {
+        "search": latency_stats(search_times),
+        "query": {
+            **latency_stats(query_times),
+            "failures": failures,
+            "batch_seconds": round(batch_seconds, 3),
+            "batch_failures": sum(response is None for response in responses),
+            "batch_queries_per_second": round(len(queries) / batch_seconds, 2),
+        },
+    }
+
+
+#prints every compared metric against the baseline, returns the ones that got worse than tolerance
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    print(f"\n{'metric':40} {'baseline':>12} {'current':>12} {'change':>9}")
+    for (section, name), higher_is_better in COMPARED_METRICS.items():
+        old, new = baseline.get(section, {}).get(name), results.get(section, {}).get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = "  ❌" if worse > tolerance else ""
+        print(f"{section + '.' + name:40} {old:>12} {new:>12} {change:>+8.1%}{flag}")
+        if worse > tolerance:
+            regressions.append(f"{section}.{name}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ingest and query benchmark on a synthetic corpus")
+    parser.add_argument("--docs", type=int, default=20, help="Documents per format (default: 20)")
+    parser.add_argument("--pages", type=int, default=5, help="Pages per document (default: 5)")
+    parser.add_argument("--formats", type=str, default=",".join(FORMATS),
+                        help=f"Comma separated formats to generate (default: {','.join(FORMATS)})")
+    parser.add_argument("--queries", type=int, default=50, help="Number of queries to time (default: 50)")
+    parser.add_argument("--chunk-size", type=int, default=800)
+    parser.add_argument("--chunk-overlap", type=int, default=80)
+    parser.add_argument("--splitter-type", type=str, default="recursive", choices=["recursive", "character", "token"])
+    parser.add_argument("--loader-backend", type=str, default="thread", choices=["thread", "process"])
+    parser.add_argument("--index-type", type=str, default="flat", choices=["flat", "ivf", "hnsw", "ivfpq"])
+    parser.add_argument("--vector-codec", type=str, default="fp32", choices=["fp32", "fp16", "int8"])
+    parser.add_argument("--streaming", action="store_true", help="Ingest with populate_database --streaming")
+    parser.add_argument("--num_chunks", dest="k", type=int, default=5, help="Chunks retrieved per query (default: 5)")
+    parser.add_argument("--max_context", type=int, default=2000)
+    parser.add_argument("--no_hybrid", action="store_true", help="Vector search only")
+    parser.add_argument("--concurrency", type=int, default=4, help="max_concurrency of the batch run (default: 4)")
+    parser.add_argument("--prefill-ms", type=float, default=20.0,
+                        help="Stub LLM prefill time per 1000 prompt tokens in ms (default: 20)")
+    parser.add_argument("--token-ms", type=float, default=2.0,
+                        help="Stub LLM time per generated token in ms (default: 2)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="JSON file to write")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative change counted as a regression by --compare (default: 0.2)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary corpus and index")
+    parser.add_argument("--verbose", action="store_true", help="Show populate_database output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    # everything below runs against local fakes, nothing may reach the network
+    install_fake_embeddings()
+    tokenizer = ensure_tokenizer()
+    stub = StubOllama(args.prefill_ms, args.token_ms).start()
+    os.environ["OLLAMA_HOST"] = stub.url
+
+    work_dir = tempfile.mkdtemp(prefix="rag-benchmark-")
+    data_path, faiss_path = os.path.join(work_dir, "data"), os.path.join(work_dir, "faiss")
+    try:
+        formats, skipped = [], []
+        for fmt in (f.strip() for f in args.formats.split(",") if f.strip()):
+            dependency = LOADER_DEPENDENCIES.get(fmt)
+            if dependency and importlib.util.find_spec(dependency) is None:
+                print(f"⚠️ Skipping {fmt}: its loader needs {dependency}, which is not installed")
+                skipped.append(fmt)
+            else:
+                formats.append(fmt)
+        print(f"📝 Generating {args.docs} documents x {args.pages} pages per format in {work_dir}...")
+        written = generate_corpus(data_path, CORPUS_FOLDER, args.docs, args.pages, formats=formats, seed=args.seed)
+        files = [path for paths in written.values() for path in paths]
+        corpus = {
+            "files": len(files),
+            "bytes": sum(os.path.getsize(path) for path in files),
+            "formats": {fmt: len(paths) for fmt, paths in written.items()},
+            "skipped_formats": skipped,
+        }
+
+        print("📦 Ingesting...")
+        ingest = run_ingest(args, data_path, faiss_path, len(files))
+        print(f"✅ {ingest['files_indexed']}/{ingest['files']} files, {ingest['chunks']} chunks in {ingest['seconds']}s "
+              f"({ingest['docs_per_second']} docs/s, {ingest['chunks_per_second']} chunks/s), "
+              f"index {ingest['index_mb']} MB, docstore {ingest['docstore_mb']} MB")
+
+        import query
+        from index_manager import IndexManager
+        from answer_cache import AnswerCache
+        # point query.py at the benchmark index instead of the repo's faiss folder
+        query.FAISS_PATH = faiss_path
+        query.INDEX_MANAGER = IndexManager(faiss_path, embedding_factory=query.get_embedding_function)
+        query.ANSWER_CACHE = AnswerCache(os.path.join(work_dir, "answer_cache", "answers.sqlite"))
+
+        print(f"🔎 Running {args.queries} queries...")
+        timings = asyncio.run(run_queries(args, make_queries(args.queries, seed=args.seed)))
+        print(f"✅ query p50 {timings['query'].get('p50_ms')} ms, p95 {timings['query'].get('p95_ms')} ms, "
+              f"p99 {timings['query'].get('p99_ms')} ms, batch {timings['query']['batch_queries_per_second']} queries/s")
+
+        print("🔁 Updating the index after removing one file and changing another...")
+        update = run_update_check(args, data_path, faiss_path, written)
+        print(f"✅ Updated in {update['seconds']}s, {update['chunks']} chunks, {update['index_vectors']} vectors, "
+              f"self recall@{SELF_RECALL_K} {update['self_recall']}")
+    finally:
+        stub.stop()
+        if args.keep:
+            print(f"📁 Corpus and index kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "tokenizer": tokenizer,
+        },
+        "corpus": corpus,
+        "ingest": ingest,
+        **timings,
+        "update": update,
+        "memory": {"peak_rss_mb": peak_rss_mb()},
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results written to {args.output}")
+
+    if update["index_vectors"] != update["chunks"] or update["self_recall"] < MIN_SELF_RECALL:
+        print(f"\n❌ The index no longer matches the docstore after the incremental update "
+              f"({update['index_vectors']} vectors for {update['chunks']} chunks, "
+              f"self recall {update['self_recall']} < {MIN_SELF_RECALL})")
+        sys.exit(1)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n❌ Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\n✅ No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import re
+import math
+import logging
+from array import array
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from langchain_core.documents import Document
+
+#the inverted index file written next to faiss.index
+BM25_FILE = "bm25.npz"
+#usual BM25 parameters: term frequency saturation and document length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+#constant of reciprocal rank fusion, a hit at rank r adds 1 / (RRF_K + r)
+RRF_K = 60
+
+#words that are in nearly every chunk, they only make the posting lists longer
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were which with".split()
+)
+_TOKEN_RE = re.compile(r"\w+")
+
+
+#lower case words and numbers, so "Article 12" matches "article 12" and "LOLR" matches "lolr"
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in STOP_WORDS]
+
+
+#builds the inverted index of every chunk in the vector store and saves it to path
+#postings are keyed by the chunk's position in the faiss index, same as the sqlite docstore
+def write_bm25_index(path: str, index_to_docstore_id: Dict[int, str], docstore) -> None:
+    term_ids: Dict[str, int] = {}
+    posting_terms, posting_positions, posting_tfs = array("i"), array("i"), array("H")
+    doc_lengths = {}
+    for pos, doc_id in index_to_docstore_id.items():
+        doc = docstore.search(doc_id)
+        if not isinstance(doc, Document):
+            continue
+        tokens = tokenize(doc.page_content)
+        doc_lengths[int(pos)] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+            posting_positions.append(int(pos))
+            posting_tfs.append(min(tf, 65535))
+
+    num_positions = max(doc_lengths, default=-1) + 1
+    lengths = np.zeros(num_positions, dtype=np.int32)
+    for pos, length in doc_lengths.items():
+        lengths[pos] = length
+    terms = np.frombuffer(posting_terms, dtype=np.int32)
+    order = np.argsort(terms, kind="stable")
+    offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(terms, minlength=len(term_ids)), out=offsets[1:])
+    # terms never contain a newline, so the vocabulary is stored as one utf-8 string
+    vocabulary = "\n".join(term_ids).encode("utf-8")
+
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path,
+             vocabulary=np.frombuffer(vocabulary, dtype=np.uint8),
+             offsets=offsets,
+             positions=np.frombuffer(posting_positions, dtype=np.int32)[order],
+             tfs=np.frombuffer(posting_tfs, dtype=np.uint16)[order],
+             doc_lengths=lengths)
+    os.replace(tmp_path, path)
+
+
+class BM25Index:
+    """Inverted index over the chunk texts, searched with BM25 to complement the vector search."""
+
+    def __init__(self, vocabulary: List[str], offsets, positions, tfs, doc_lengths):
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.positions = positions
+        self.tfs = tfs.astype(np.float32)
+        self.doc_lengths = doc_lengths.astype(np.float32)
+        self.num_docs = int(np.count_nonzero(doc_lengths)) or 1
+        self.avg_length = float(self.doc_lengths.sum()) / self.num_docs or 1.0
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as data:
+            vocabulary = data["vocabulary"].tobytes().decode("utf-8")
+            return cls(vocabulary.split("\n") if vocabulary else [],
+                       data["offsets"], data["positions"], data["tfs"], data["doc_lengths"])
+
+    #top k (scores, positions) for one query, highest score first
+    #with allowed (sorted index positions) only those chunks are scored
+    def search(self, query_text: str, k: int,
+               allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        matched_positions, matched_scores = [], []
+        for term in set(tokenize(query_text)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            positions, tfs = self.positions[start:end], self.tfs[start:end]
+            idf = math.log(1 + (self.num_docs - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[positions] / self.avg_length)
+            matched_positions.append(positions)
+            matched_scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not matched_positions:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        # only the chunks that contain a query term are scored
+        positions, inverse = np.unique(np.concatenate(matched_positions), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(matched_scores)).astype(np.float32)
+        if allowed is not None:
+            keep = np.isin(positions, allowed, assume_unique=True)
+            positions, scores = positions[keep], scores[keep]
+        if len(positions) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            positions, scores = positions[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return scores[order], positions[order].astype(np.int64)
+
+
+#merges several rankings of index positions (best first) by reciprocal rank fusion
+#returns the top k (position, fused score) pairs, highest score first
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int) -> List[Tuple[int, float]]:
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, pos in enumerate(ranking, start=1):
+            if pos == -1:
+                continue
+            fused[int(pos)] = fused.get(int(pos), 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+#the index saved next to the faiss index, None if there is none (databases from before it existed)
+def load_bm25_index(path: str) -> Optional[BM25Index]:
+    try:
+        return BM25Index.load(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.error(f"Could not load BM25 index {path}: {e}")
+        return None
@@ -0,0 +1,97 @@
+import re
+import zlib
+from typing import Dict, List
+import numpy as np
+
+#chunks whose estimated word 5-gram jaccard similarity is at least this are treated as copies
+DEFAULT_THRESHOLD = 0.85
+#hash functions in a minhash signature
+NUM_PERM = 128
+#the signature is cut into this many bands of NUM_PERM // BANDS values, chunks that agree on all
+#values of any band are compared. With 16 bands of 8 a pair at 0.85 similarity is compared 99% of the
+#time and a pair at 0.5 about 6% of the time
+BANDS = 16
+#words per shingle
+SHINGLE_WORDS = 5
+#seed of the hash functions, fixed so signatures are the same in every process
+SEED = 1
+_PRIME = (1 << 61) - 1
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD_RE = re.compile(r"\w+")
+
+
+#crc32 of every run of SHINGLE_WORDS lower case words of text (the whole text if it is shorter)
+def shingles(text: str) -> np.ndarray:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) <= SHINGLE_WORDS:
+        grams = {" ".join(words)} if words else set()
+    else:
+        grams = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+#where a chunk is (also) found, kept in the "duplicates" metadata of the chunk that stays in the index
+def chunk_ref(chunk) -> Dict:
+    return {"id": chunk.metadata.get("id"), "source": chunk.metadata.get("source", "Unknown"),
+            "page": chunk.metadata.get("page", "Unknown")}
+
+
+class ChunkDeduplicator:
+    """
+    Drops chunks that are near copies of a chunk seen before, e.g. the articles a consolidated version
+    of a law repeats from the original. Every chunk gets a minhash signature of its word 5-grams and
+    is looked up in an LSH index of the chunks kept so far. If one of them is similar enough the chunk
+    is dropped and its id, source and page are added to duplicates[<id of the kept chunk>], otherwise
+    it is kept and added to the index. Chunks can be added in batches, later batches are compared
+    against everything kept before.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, num_perm: int = NUM_PERM, bands: int = BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.RandomState(SEED)
+        self._a = rng.randint(1, _PRIME, size=self.rows * bands, dtype=np.uint64)
+        self._b = rng.randint(0, _PRIME, size=self.rows * bands, dtype=np.uint64)
+        # band -> {values of the band: positions of the kept chunks with those values}
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self._signatures: List[np.ndarray] = []
+        self._ids: List[str] = []
+        #id of a kept chunk -> refs of the chunks dropped as its copies
+        self.duplicates: Dict[str, List[Dict]] = {}
+        self.removed = 0
+
+    #minhash signature of text, None for text without words
+    def signature(self, text: str):
+        hashes = shingles(text)
+        if not len(hashes):
+            return None
+        # uint64 arithmetic wraps around, the values are then taken modulo the prime and cut to 32 bits
+        return (((hashes[:, None] * self._a + self._b) % _PRIME) & _MAX_HASH).min(axis=0)
+
+    #returns the chunks that are not copies of an earlier one, in their order
+    def add(self, chunks: List) -> List:
+        kept = []
+        for chunk in chunks:
+            signature = self.signature(chunk.page_content)
+            if signature is None:
+                kept.append(chunk)
+                continue
+            keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+            candidates = {pos for band, key in enumerate(keys) for pos in self._buckets[band].get(key, ())}
+            best, best_similarity = None, self.threshold
+            for pos in candidates:
+                similarity = float(np.mean(self._signatures[pos] == signature))
+                if similarity >= best_similarity:
+                    best, best_similarity = pos, similarity
+            if best is not None:
+                self.duplicates.setdefault(self._ids[best], []).append(chunk_ref(chunk))
+                self.removed += 1
+                continue
+            pos = len(self._signatures)
+            self._signatures.append(signature)
+            self._ids.append(chunk.metadata.get("id"))
+            for band, key in enumerate(keys):
+                self._buckets[band].setdefault(key, []).append(pos)
+            kept.append(chunk)
+        return kept
@@ -0,0 +1,83 @@
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from instrumentation import count, span
+
+#sqlite limits the number of ? parameters in one statement, look hashes up in slices of this size
+LOOKUP_BATCH = 500
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding function with an on-disk cache of vectors.
+    Vectors are stored in a SQLite table keyed by the hash of (model name, text),
+    so only texts the model has never seen reach the encoder.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache_path: str):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), LOOKUP_BATCH):
+                batch = keys[i:i + LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+        return found
+
+    def _store(self, items) -> None:
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", items)
+            self._conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(list(set(keys)))
+
+        #identical texts in one call are only encoded once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        hits = len(texts) - sum(1 for key in keys if key in missing)
+        self.hits += hits
+        self.misses += len(missing)
+        count("embedding_cache", hits, result="hit")
+        count("embedding_cache", len(missing), result="miss")
+
+        if missing:
+            logging.info(f"Embedding cache: {len(missing)} misses out of {len(texts)} texts")
+            with span("embed.encode", texts=len(missing)):
+                vectors = self.embeddings.embed_documents(list(missing.values()))
+            new = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, vectors)}
+            try:
+                self._store([(key, vector.tobytes()) for key, vector in new.items()])
+            except Exception as e:
+                # the cache is only an optimization, a failed write must not stop the ingest
+                logging.error(f"Could not write embedding cache: {e}")
+            found.update(new)
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
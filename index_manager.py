@@ -0,0 +1,414 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+#name of the stamp file written next to the index every time populate_database saves it
+VERSION_FILE = "version.json"
+#the faiss index, the chunks themselves are in sqlite_docstore.DOCSTORE_FILE
+INDEX_FILE = "faiss.index"
+#populate_database.py --shards builds one complete index per data folder in <faiss path>/shards/<folder>
+SHARDS_DIR = "shards"
+
+
+#folder of the shard of one data folder
+def shard_path(faiss_path: str, shard: str) -> str:
+    return os.path.join(faiss_path, SHARDS_DIR, shard)
+
+
+#names of the shards that have a finished index (a version stamp), sorted
+def shard_names(faiss_path: str) -> List[str]:
+    shards_dir = os.path.join(faiss_path, SHARDS_DIR)
+    if not os.path.isdir(shards_dir):
+        return []
+    return sorted(name for name in os.listdir(shards_dir)
+                  if os.path.exists(os.path.join(shards_dir, name, VERSION_FILE)))
+
+
+#writes a new generation stamp for the index in faiss_path
+#written last, after every index file has been saved, so readers never pick up a half written index
+#the temp file + os.replace makes the write atomic
+def write_index_version(faiss_path: str, **info) -> Dict:
+    stamp = {"generation": uuid.uuid4().hex, "created": time.time(), **info}
+    os.makedirs(faiss_path, exist_ok=True)
+    version_path = os.path.join(faiss_path, VERSION_FILE)
+    tmp_path = f"{version_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(stamp, f)
+    os.replace(tmp_path, version_path)
+    return stamp
+
+
+#returns the stamp written by write_index_version, None if there is none or it can't be read
+def read_index_version(faiss_path: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(faiss_path, VERSION_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.error(f"Could not read index version in {faiss_path}: {e}")
+        return None
+
+
+class IndexManager:
+    """
+    Holds the FAISS index loaded from faiss_path and reloads it when populate_database
+    writes a new version stamp. The new index is fully loaded before it replaces the old
+    one. Answers cached for the old index are not reused, they are scoped to its version.
+    """
+
+    def __init__(self, faiss_path: str, embedding_factory: Callable):
+        self.faiss_path = faiss_path
+        self.embedding_factory = embedding_factory
+        self._embeddings = None
+        self._embedding_backend = None
+        self._db = None
+        self._version = None
+        self._stamp_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> Optional[str]:
+        return self._version
+
+    #returns the current index, loading or swapping it first if the stamp on disk changed
+    def get(self):
+        if self._stamp_changed():
+            self.reload()
+        if self._db is None:
+            raise FileNotFoundError(f"FAISS DB not initialized. Ensure {self.faiss_path} contains valid index files.")
+        return self._db
+
+    #the stat is cheap, the stamp itself is only read when its mtime moved
+    def _stamp_changed(self) -> bool:
+        try:
+            mtime = os.stat(os.path.join(self.faiss_path, VERSION_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime is None:
+            # no stamp: either an index from before versioning, or the index is being rebuilt
+            # keep whatever is loaded until a new stamp appears
+            return self._db is None
+        return mtime != self._stamp_mtime
+
+    def _current_version(self):
+        stamp = read_index_version(self.faiss_path)
+        if stamp:
+            return stamp.get("generation")
+        # indexes saved before versioning have no stamp, fall back to the index file's mtime
+        for name in (INDEX_FILE, "index.faiss"):
+            index_file = os.path.join(self.faiss_path, name)
+            if os.path.exists(index_file):
+                return f"legacy-{os.stat(index_file).st_mtime_ns}"
+        return None
+
+    def reload(self) -> None:
+        import faiss
+
+        with self._lock:
+            try:
+                stamp_mtime = os.stat(os.path.join(self.faiss_path, VERSION_FILE)).st_mtime_ns
+            except FileNotFoundError:
+                stamp_mtime = None
+            if self._db is not None and stamp_mtime == self._stamp_mtime:
+                return  # another thread already swapped in this version
+            version = self._current_version()
+            if version is None:
+                logging.error(f"FAISS DB not found at {self.faiss_path}. Ensure populate_database.py has been run.")
+                return
+            # an index rebuilt with another embedding backend needs a new embedding function
+            backend = (read_index_version(self.faiss_path) or {}).get("embedding_backend")
+            try:
+                if self._embeddings is None or backend != self._embedding_backend:
+                    self._embeddings = self.embedding_factory()
+                    self._embedding_backend = backend
+                faiss.omp_set_num_threads(6)
+                db = load_vectorstore(self.faiss_path, self._embeddings, mmap=True)
+            except Exception as e:
+                logging.error(f"Failed to load FAISS index: {e}")
+                return
+            # hybrid search reads the BM25 index saved next to this index
+            db.faiss_path = self.faiss_path
+            # single assignment, queries already running keep the old index object
+            self._db, self._version, self._stamp_mtime = db, version, stamp_mtime
+            logging.info(f"FAISS DB loaded successfully (version {version}).")
+
+
+#writes the faiss index, the sqlite docstore and the BM25 index to faiss_path
+#each file is written under a temp name and swapped in
+def save_vectorstore(vectorstore, faiss_path: str) -> None:
+    import faiss
+    from sqlite_docstore import DOCSTORE_FILE, write_sqlite_docstore
+    from bm25_index import BM25_FILE, write_bm25_index
+
+    os.makedirs(faiss_path, exist_ok=True)
+    index_path = os.path.join(faiss_path, INDEX_FILE)
+    faiss.write_index(vectorstore.index, f"{index_path}.tmp")
+    os.replace(f"{index_path}.tmp", index_path)
+    write_sqlite_docstore(os.path.join(faiss_path, DOCSTORE_FILE), vectorstore.index_to_docstore_id,
+                          vectorstore.docstore)
+    write_bm25_index(os.path.join(faiss_path, BM25_FILE), vectorstore.index_to_docstore_id, vectorstore.docstore)
+    # files of the old langchain save_local layout (index.faiss + pickled index.pkl) are no longer used
+    for name in ("index.faiss", "index.pkl"):
+        if os.path.exists(os.path.join(faiss_path, name)):
+            os.remove(os.path.join(faiss_path, name))
+
+
+#loads the vector store saved by save_vectorstore
+#mmap=True is for querying: the index is memory mapped so the OS pages vectors in on demand,
+#and chunks are only read from sqlite when a search returns them. The result is read-only.
+#mmap=False loads everything into memory so populate_database can add and delete chunks.
+def load_vectorstore(faiss_path: str, embeddings, mmap: bool = True):
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from sqlite_docstore import DOCSTORE_FILE, SQLiteDocstore, SQLiteIndexMap
+
+    docstore_path = os.path.join(faiss_path, DOCSTORE_FILE)
+    if not os.path.exists(docstore_path):
+        if os.path.exists(os.path.join(faiss_path, "index.pkl")):
+            logging.warning("Loading a database saved in the old pickle format. "
+                            "Run populate_database.py again to convert it.")
+            return FAISS.load_local(faiss_path, embeddings=embeddings, allow_dangerous_deserialization=True)
+        raise FileNotFoundError(f"No docstore found in {faiss_path}")
+
+    index = read_faiss_index(os.path.join(faiss_path, INDEX_FILE), mmap)
+    if mmap:
+        #the docstore file is opened here, next to the index, see sqlite_docstore._Connection
+        docstore = SQLiteDocstore(docstore_path)
+        return FAISS(embeddings, index, docstore, SQLiteIndexMap(docstore))
+    docs, index_to_docstore_id = {}, {}
+    for pos, doc_id, doc in SQLiteDocstore(docstore_path).iter_all():
+        index_to_docstore_id[pos] = doc_id
+        docs[doc_id] = doc
+    return FAISS(embeddings, index, InMemoryDocstore(docs), index_to_docstore_id)
+
+
+#memory mapped indexes are read-only, and need a faiss version that supports mapping them
+def read_faiss_index(path: str, mmap: bool = True):
+    import faiss
+
+    if mmap and hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC)
+        except RuntimeError as e:
+            logging.warning(f"Could not memory map {path}, reading it into memory: {e}")
+    return faiss.read_index(path)
+
+
+#--- index types ---
+#the approximate index types add_to_db can build instead of the default exact (flat) index
+INDEX_TYPES = ["flat", "ivf", "hnsw", "ivfpq"]
+#saved next to the index so query.py knows which type it is searching
+INDEX_PARAMS_FILE = "index_params.json"
+#faiss wants about 39 training points per IVF list
+TRAIN_POINTS_PER_LIST = 39
+#default nprobe (IVF lists scanned per query) and efSearch (HNSW candidate list size)
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+#how the flat, ivf and hnsw indexes store vectors: fp16 takes half the memory of fp32, int8 a quarter
+#(every dimension scaled to its range over the training vectors), ivfpq always stores PQ codes
+VECTOR_CODECS = ["fp32", "fp16", "int8"]
+#faiss factory names of the inverted lists' storage for every codec
+IVF_CODES = {"fp32": "Flat", "fp16": "SQfp16", "int8": "SQ8"}
+#vectors the int8 ranges are trained on
+SQ_TRAIN_POINTS = 10000
+#neighbours and sample queries of the recall check of compressed vectors
+RECALL_K = 10
+RECALL_QUERIES = 500
+
+
+def index_config(index_type: str = "flat", nlist: Optional[int] = None,
+                 hnsw_m: int = 32, pq_m: int = 16, vector_codec: str = "fp32") -> Dict:
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {index_type}")
+    if vector_codec not in VECTOR_CODECS:
+        raise ValueError(f"Unknown vector codec: {vector_codec}")
+    config = {"index_type": index_type, "nlist": nlist, "hnsw_m": hnsw_m, "pq_m": pq_m}
+    # fp32 is left out, so the manifests of indexes built before codecs existed still match
+    if vector_codec != "fp32":
+        if index_type == "ivfpq":
+            logging.warning("ivfpq indexes always store PQ codes, ignoring the vector codec.")
+        else:
+            config["vector_codec"] = vector_codec
+    return config
+
+
+#fills in the number of IVF lists from the corpus size when it wasn't given (about 4 * sqrt(n))
+def resolve_nlist(config: Dict, num_vectors: int) -> Dict:
+    if config["index_type"] not in ("ivf", "ivfpq") or config.get("nlist"):
+        return config
+    nlist = int(4 * num_vectors ** 0.5)
+    # keep enough training points per list
+    nlist = max(1, min(nlist, num_vectors // TRAIN_POINTS_PER_LIST))
+    return {**config, "nlist": nlist}
+
+
+#number of vectors to train the index on, 0 if the type needs no training
+def training_size(config: Dict) -> int:
+    if config["index_type"] == "ivf":
+        return config["nlist"] * TRAIN_POINTS_PER_LIST
+    if config["index_type"] == "ivfpq":
+        # the 256 centroids of every PQ sub-quantizer need training points too
+        return max(config["nlist"], 256) * TRAIN_POINTS_PER_LIST
+    if config.get("vector_codec") == "int8":
+        return SQ_TRAIN_POINTS
+    return 0
+
+
+#builds and trains an empty faiss index of the configured type
+def build_faiss_index(dim: int, config: Dict, training_vectors=None):
+    import faiss
+    import numpy as np
+
+    index_type = config["index_type"]
+    codec = config.get("vector_codec", "fp32")
+    if codec != "fp32" and index_type in ("flat", "hnsw"):
+        qtype = faiss.ScalarQuantizer.QT_fp16 if codec == "fp16" else faiss.ScalarQuantizer.QT_8bit
+        if index_type == "flat":
+            index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+        else:
+            index = faiss.IndexHNSWSQ(dim, qtype, config["hnsw_m"])
+            index.hnsw.efSearch = DEFAULT_EF_SEARCH
+        if not index.is_trained:
+            index.train(np.ascontiguousarray(training_vectors, dtype=np.float32))
+        return index
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, config["hnsw_m"])
+        index.hnsw.efSearch = DEFAULT_EF_SEARCH
+        return index
+
+    training_vectors = np.ascontiguousarray(training_vectors, dtype=np.float32)
+    nlist = min(config["nlist"], len(training_vectors))
+    factory = f"IVF{nlist},{IVF_CODES[codec]}"
+    if index_type == "ivfpq":
+        if dim % config["pq_m"]:
+            raise ValueError(f"pq_m ({config['pq_m']}) must divide the embedding size ({dim})")
+        if len(training_vectors) < 256:
+            logging.warning("Too few vectors to train product quantization, building an IVF index instead.")
+        else:
+            factory = f"IVF{nlist},PQ{config['pq_m']}"
+    index = faiss.index_factory(dim, factory, faiss.METRIC_L2)
+    if factory.endswith(f"PQ{config['pq_m']}"):
+        # polysemous codes are never used for search here, and training them takes most of the time
+        faiss.downcast_index(index).do_polysemous_training = False
+    index.train(training_vectors)
+    index.nprobe = min(DEFAULT_NPROBE, nlist)
+    return index
+
+
+#share of the exact (float32, brute force) RECALL_K nearest neighbours of a sample of vectors that
+#index finds, vectors are the ones stored in index in the same order
+#neighbours as close as the k-th exact one count as found, so copies of a chunk don't lower it
+def vector_recall(index, vectors, k: int = RECALL_K, queries: int = RECALL_QUERIES) -> float:
+    import faiss
+    import numpy as np
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    k = min(k, len(vectors))
+    rows = np.random.RandomState(0).choice(len(vectors), min(queries, len(vectors)), replace=False)
+    exact_distances, _ = faiss.knn(vectors[rows], vectors, k)
+    _, found = index.search(vectors[rows], k)
+    found_distances = ((vectors[np.maximum(found, 0)] - vectors[rows][:, None, :]) ** 2).sum(axis=2)
+    hits = (found >= 0) & (found_distances <= exact_distances[:, -1:] * (1 + 1e-5) + 1e-6)
+    return float(hits.mean())
+
+
+def write_index_params(faiss_path: str, config: Dict) -> None:
+    os.makedirs(faiss_path, exist_ok=True)
+    with open(os.path.join(faiss_path, INDEX_PARAMS_FILE), "w", encoding="utf-8") as f:
+        json.dump(config, f)
+
+
+#indexes saved before index types existed are flat
+def read_index_params(faiss_path: str) -> Dict:
+    try:
+        with open(os.path.join(faiss_path, INDEX_PARAMS_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return index_config("flat")
+
+
+#per search overrides of nprobe / efSearch, None when there is nothing to override
+#passed to index.search so concurrent queries with different settings don't interfere
+def search_parameters(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    import faiss
+
+    if nprobe:
+        try:
+            faiss.extract_index_ivf(index)
+            return faiss.SearchParametersIVF(nprobe=nprobe)
+        except RuntimeError:
+            pass
+    if ef_search and isinstance(faiss.downcast_index(index), faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search)
+    return None
+
+
+#--- filtered search ---
+#vectors reconstructed per slice in subset_search, bounds the memory of a broad filter
+SUBSET_SLICE = 65536
+
+
+#k nearest neighbours of every query among the given index positions only (e.g. one source's chunks)
+#every row gets min(k, len(positions)) results, as (distances, positions) like index.search
+#flat and hnsw indexes hand back their stored vectors, so the subset is searched by brute force
+#and the cost follows the subset size. IVF indexes can't, they are searched with an id selector
+#and any row that comes back short is searched again over every list.
+def subset_search(index, vectors, positions, k: int,
+                  nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    import faiss
+    import numpy as np
+
+    positions = np.asarray(positions, dtype=np.int64)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    k = min(k, len(positions))
+    if k == 0:
+        return (np.empty((len(vectors), 0), dtype=np.float32),
+                np.empty((len(vectors), 0), dtype=np.int64))
+    try:
+        return _subset_knn(index, vectors, positions, k)
+    except RuntimeError:
+        pass  # no stored vectors to reconstruct (IVF without a direct map)
+
+    selector = faiss.IDSelectorBatch(positions)
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is None:
+        params = faiss.SearchParameters(sel=selector)
+        return index.search(vectors, k, params=params)
+    params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe or ivf.nprobe)
+    distances, indices = index.search(vectors, k, params=params)
+    short = (indices == -1).any(axis=1)
+    if short.any():
+        # the probed lists held fewer than k of the subset, scanning all of them finds every one
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nlist)
+        distances[short], indices[short] = index.search(vectors[short], k, params=params)
+    return distances, indices
+
+
+#exact knn over the reconstructed subset vectors, one slice at a time
+def _subset_knn(index, vectors, positions, k: int):
+    import faiss
+    import numpy as np
+
+    best_distances, best_indices = None, None
+    for start in range(0, len(positions), SUBSET_SLICE):
+        slice_positions = positions[start:start + SUBSET_SLICE]
+        subset = index.reconstruct_batch(slice_positions)
+        distances, indices = faiss.knn(vectors, subset, min(k, len(slice_positions)))
+        indices = slice_positions[indices]
+        if best_distances is not None:
+            distances = np.hstack([best_distances, distances])
+            indices = np.hstack([best_indices, indices])
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        best_distances = np.take_along_axis(distances, order, axis=1)
+        best_indices = np.take_along_axis(indices, order, axis=1)
+    return best_distances, best_indices
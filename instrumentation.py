@@ -0,0 +1,210 @@
+import os
+import re
+import json
+import time
+import atexit
+import logging
+import threading
+import multiprocessing
+from typing import Dict, Optional, Tuple
+
+#Spans time one stage of ingest or a query, counters add up events (cache hits, tokens, files).
+#Everything is off unless a trace file, metrics file or metrics port is configured, either with
+#configure() or with these environment variables (which worker processes inherit):
+#  RAG_TRACE_FILE    every finished span is appended to it as one JSON line
+#  RAG_METRICS_FILE  stage durations and counters in Prometheus text format, rewritten every few seconds
+#  RAG_METRICS_PORT  serves the same text at http://localhost:<port>/metrics
+#When off, span() returns a shared no-op object and count() returns at once.
+#Worker processes (e.g. the process loader backend) only append to the trace file, the metrics
+#file and port belong to the main process.
+
+#how often the metrics file is rewritten while spans are being recorded, in seconds
+METRICS_WRITE_INTERVAL = 5.0
+
+_enabled = False
+_trace_file = None
+_metrics_file = None
+_lock = threading.Lock()
+_stage_totals: Dict[str, list] = {}  # stage -> [count, total seconds]
+_counters: Dict[Tuple[str, Tuple], float] = {}  # (name, sorted labels) -> value
+_last_metrics_write = 0.0
+_metrics_server = None
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        _record_span(self, duration)
+        return False
+
+    #adds attributes known only once the stage ran (e.g. number of pages loaded)
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+#times the block under `name`:  with span("query.search", k=5): ...
+def span(name: str, **attrs):
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(name, attrs)
+
+
+#adds value to the counter `name`, labels split it (e.g. count("answer_cache", result="hit"))
+def count(name: str, value: float = 1, **labels) -> None:
+    if not _enabled or not value:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+#turns instrumentation on for whichever outputs are given, and exports them to the environment
+#so worker processes started afterwards record into the same trace file
+def configure(trace_file: Optional[str] = None, metrics_file: Optional[str] = None,
+              metrics_port: Optional[int] = None) -> None:
+    global _enabled, _trace_file, _metrics_file
+    if multiprocessing.parent_process() is not None:
+        metrics_file = metrics_port = None
+    if trace_file:
+        _trace_file = trace_file
+        os.environ["RAG_TRACE_FILE"] = trace_file
+    if metrics_file:
+        _metrics_file = metrics_file
+        os.environ["RAG_METRICS_FILE"] = metrics_file
+    if metrics_port:
+        serve_metrics(int(metrics_port))
+    _enabled = bool(_trace_file or _metrics_file or _metrics_server)
+
+
+def _record_span(s: _Span, duration: float) -> None:
+    with _lock:
+        totals = _stage_totals.setdefault(s.name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        write_due = _metrics_file and time.time() - _last_metrics_write >= METRICS_WRITE_INTERVAL
+    if _trace_file:
+        event = {"name": s.name, "start": round(s.wall_start, 6), "duration_ms": round(duration * 1000, 3),
+                 "pid": os.getpid(), "thread": threading.current_thread().name, **s.attrs}
+        try:
+            # one short line per write, appends from several processes don't interleave
+            with open(_trace_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(event, default=str) + "\n")
+        except OSError as e:
+            logging.error(f"Could not write trace file {_trace_file}: {e}")
+    if write_due:
+        write_metrics()
+
+
+def _metric_name(name: str) -> str:
+    return "rag_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+#the current stage durations and counters in Prometheus text format
+def metrics_text() -> str:
+    with _lock:
+        stages = {name: list(totals) for name, totals in _stage_totals.items()}
+        counters = dict(_counters)
+    lines = ["# HELP rag_stage_duration_seconds Time spent in each ingest and query stage.",
+             "# TYPE rag_stage_duration_seconds summary"]
+    for name, (n, total) in sorted(stages.items()):
+        lines.append(f'rag_stage_duration_seconds_sum{{stage="{_label_value(name)}"}} {total:.6f}')
+        lines.append(f'rag_stage_duration_seconds_count{{stage="{_label_value(name)}"}} {n}')
+    by_name: Dict[str, list] = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name, series in sorted(by_name.items()):
+        metric = _metric_name(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        for labels, value in sorted(series):
+            label_text = ",".join(f'{key}="{_label_value(v)}"' for key, v in labels)
+            lines.append(f"{metric}{{{label_text}}} {value:g}" if label_text else f"{metric} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+#writes metrics_text() to the metrics file, temp file + rename so scrapers never read half a file
+def write_metrics() -> None:
+    global _last_metrics_write
+    if not _metrics_file or multiprocessing.parent_process() is not None:
+        return  # forked workers inherit the setting but their counts are partial
+    _last_metrics_write = time.time()
+    try:
+        directory = os.path.dirname(os.path.abspath(_metrics_file))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{_metrics_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(metrics_text())
+        os.replace(tmp_path, _metrics_file)
+    except OSError as e:
+        logging.error(f"Could not write metrics file {_metrics_file}: {e}")
+
+
+#serves metrics_text() at /metrics on a background thread
+def serve_metrics(port: int) -> None:
+    global _metrics_server, _enabled
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    if _metrics_server is not None:
+        return
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        _metrics_server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    except OSError as e:
+        logging.error(f"Could not serve metrics on port {port}: {e}")
+        return
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    _enabled = True
+    logging.info(f"Serving metrics at http://localhost:{port}/metrics")
+
+
+configure(os.environ.get("RAG_TRACE_FILE"), os.environ.get("RAG_METRICS_FILE"),
+          os.environ.get("RAG_METRICS_PORT"))
+atexit.register(write_metrics)
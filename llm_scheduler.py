@@ -0,0 +1,82 @@
+import heapq
+import asyncio
+import itertools
+import threading
+import contextlib
+
+
+class LLMScheduler:
+    """
+    Limits how many LLM requests are in flight at once. When all slots are taken, waiting
+    requests are let through lowest priority number first, then in arrival order.
+    Works across event loops, so query_rag calls from different threads share the same limit.
+    """
+
+    def __init__(self, max_concurrency: int = 4):
+        self.max_concurrency = max(1, max_concurrency)
+        self._in_flight = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiting if not future.done())
+
+    def set_max_concurrency(self, max_concurrency: int) -> None:
+        with self._lock:
+            self.max_concurrency = max(1, max_concurrency)
+            # a higher limit can let waiting requests through right away
+            while self._in_flight < self.max_concurrency and self._wake_next():
+                self._in_flight += 1
+
+    #hands a free slot to the next waiting request, returns False if nobody is waiting
+    def _wake_next(self) -> bool:
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue  # cancelled while waiting
+            future.get_loop().call_soon_threadsafe(self._grant, future)
+            return True
+        return False
+
+    async def _acquire(self, priority: int) -> None:
+        with self._lock:
+            if self._in_flight < self.max_concurrency and not self.waiting:
+                self._in_flight += 1
+                return
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiting, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # the slot may have been handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        with self._lock:
+            # the slot goes straight to the next waiting request, otherwise it is freed
+            if self._in_flight > self.max_concurrency or not self._wake_next():
+                self._in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = 0):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    #runs on the waiting request's own loop
+    def _grant(self, future) -> None:
+        if future.done():
+            # cancelled after the slot was handed to it, pass the slot on
+            self._release()
+        else:
+            future.set_result(None)
@@ -18,6 +18,12 @@ def get_interactive_args():
         "max_context_length": context_length,
         "source_filter": source_filter or None,
         "show_chunks": show_chunks,
+        "use_cache": True,
+        "stream": True,
+        "nprobe": None,
+        "ef_search": None,
+        "hybrid": True,
+        "shard": None,
         "output": output_file
     }
 
@@ -26,7 +32,7 @@ def main(cli_args=None):
     argparse = importlib.import_module("argparse")
     logging = importlib.import_module("logging")
     asyncio = importlib.import_module("asyncio")
-    query = importlib.import_module("query")
+    query_server = importlib.import_module("query_server")
 
     #parses arguments
     logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -37,8 +43,21 @@ def main(cli_args=None):
     parser.add_argument("--model", type=str, default="phi3:mini", help="Ollama model name")
     parser.add_argument("--output", type=str, help="Output file")
     parser.add_argument("--max_context", type=int, default=2000, help="Max token context")
-    parser.add_argument("--source_filter", type=str, help="Filter by source")
+    parser.add_argument("--source_filter", type=str,
+                        help="Only search chunks from this source: a file path, file name, file name prefix (e.g. SI_CBL_2019) or data folder")
     parser.add_argument("--show_chunks", action="store_true", help="Show chunk content")
+    parser.add_argument("--no_cache", action="store_true", help="Always ask the LLM, skip the answer cache")
+    parser.add_argument("--nprobe", type=int, default=None, help="IVF lists searched per query (ivf/ivfpq indexes only)")
+    parser.add_argument("--ef_search", type=int, default=None, help="HNSW search depth (hnsw indexes only)")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="Search the shard of this data folder (built with populate_database.py --shards), 'all' searches every shard")
+    parser.add_argument("--no_hybrid", action="store_true", help="Only use vector search, without BM25 keyword search")
+    parser.add_argument("--stream", action="store_true", help="Print the answer as it is generated (always on in interactive mode)")
+    parser.add_argument("--server", type=str, nargs="?", const=query_server.DEFAULT_SERVER_URL,
+                        help=f"Send the query to a running query_server.py (default address: {query_server.DEFAULT_SERVER_URL}) "
+                             "instead of loading the index and models here")
+    parser.add_argument("--trace", type=str, help="Append a JSON line with the duration of every query stage to this file")
+    parser.add_argument("--metrics_file", type=str, help="Write stage timings and counters in Prometheus text format to this file")
 
     start = time.time()
     # Parse arguments from cli_args if provided, otherwise use sys.argv
@@ -47,6 +66,9 @@ def main(cli_args=None):
     else:
         args = parser.parse_args()
 
+    if args.trace or args.metrics_file:
+        importlib.import_module("instrumentation").configure(trace_file=args.trace, metrics_file=args.metrics_file)
+
     if args.interactive or not args.query_text:
         logging.info("Interactive mode enabled.")
         input_args = get_interactive_args()
@@ -58,17 +80,64 @@ def main(cli_args=None):
             "max_context_length": args.max_context,
             "source_filter": args.source_filter,
             "show_chunks": args.show_chunks,
+            "use_cache": not args.no_cache,
+            "stream": args.stream,
+            "nprobe": args.nprobe,
+            "ef_search": args.ef_search,
+            "hybrid": not args.no_hybrid,
+            "shard": args.shard,
             "output": args.output
         }
 
-    response = asyncio.run(query.query_rag(
-        query_text=input_args["query_text"],
-        k=input_args["k"],
-        model_name=input_args["model_name"],
-        max_context_length=input_args["max_context_length"],
-        source_filter=input_args["source_filter"],
-        show_chunks=input_args["show_chunks"]
-    ))
+    #prints tokens as soon as the LLM produces them
+    def print_token(token):
+        print(token, end="", flush=True)
+
+    request = {
+        "query_text": input_args["query_text"],
+        "k": input_args["k"],
+        "model_name": input_args["model_name"],
+        "max_context_length": input_args["max_context_length"],
+        "source_filter": input_args["source_filter"],
+        "use_cache": input_args["use_cache"],
+        "nprobe": input_args["nprobe"],
+        "ef_search": input_args["ef_search"],
+        "hybrid": input_args["hybrid"],
+        "shard": input_args["shard"]
+    }
+    if input_args["stream"]:
+        print("\n🧠 MODEL RESPONSE:")
+    if args.server:
+        #the server has the index and models loaded already, only the request is sent
+        if input_args["show_chunks"]:
+            print("⚠️ Chunks are not shown when querying a server")
+        try:
+            response = query_server.remote_query(args.server, request,
+                                                 on_token=print_token if input_args["stream"] else None)
+        except OSError as e:
+            print(f"❌ Could not reach the query server at {args.server}: {e}. Start it with python query_server.py")
+            return None
+    else:
+        query = importlib.import_module("query")
+        response = asyncio.run(query.query_rag(
+            **request,
+            show_chunks=input_args["show_chunks"],
+            on_token=print_token if input_args["stream"] else None
+        ))
+    metrics = (response or {}).get("metrics") or {}
+    if (response or {}).get("cache_hit"):
+        print("♻️ Answer reused from the answer cache, add --no_cache to ask the LLM again")
+    if input_args["stream"]:
+        print()
+        if metrics.get("time_to_first_token") is not None:
+            print(f"⚡ First token after {metrics['time_to_first_token']:.2f}s, "
+                  f"{metrics['tokens_per_second'] or 0:.1f} tokens/s")
+    if metrics.get("prefill_time") is not None:
+        print(f"🧮 Prefill {metrics['prefill_time']:.2f}s for {metrics['prompt_tokens']} prompt tokens, "
+              f"generation {metrics['generation_time']:.2f}s")
+    if metrics.get("context_budget"):
+        print(f"📦 Context: {metrics['context_tokens']}/{metrics['context_budget']} tokens from "
+              f"{metrics['chunks_used']} chunks, {metrics['overlap_tokens_removed']} overlapping tokens removed")
 
     if response and input_args["output"]:
         try:
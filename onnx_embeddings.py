@@ -0,0 +1,176 @@
+import os
+import json
+import shutil
+import logging
+from typing import Dict, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+#all-MiniLM-L6-v2 was trained on at most 256 tokens, sentence-transformers cuts texts there too
+ONNX_MAX_LENGTH = 256
+#texts encoded in one onnxruntime call
+ONNX_BATCH_SIZE = 64
+#the int8 model is only used if its nearest neighbours agree this well with the fp32 model's
+MIN_RECALL = 0.9
+#neighbours compared by the recall check
+RECALL_K = 10
+#file in the model folder with the result of the recall check
+RECALL_FILE = "recall.json"
+#file names in the model folder
+FP32_FILE = "model.fp32.onnx"
+INT8_FILE = "model.int8.onnx"
+#largest difference allowed between the outputs of the fp32 onnx export and the torch model
+EXPORT_TOLERANCE = 1e-3
+
+
+#sentence-transformers resolves short names like all-MiniLM-L6-v2 to its own organisation
+def hub_model_id(model_name: str) -> str:
+    return model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+
+
+#exports model_name from the HuggingFace hub to onnx and quantizes its weights to int8
+#(dynamic quantization: activations are quantized on the fly, no calibration data needed)
+#written to a temp folder and renamed, so a half exported model is never picked up
+#raises RuntimeError if the fp32 export doesn't give the torch model's output on the sample
+def export_onnx_model(model_name: str, model_dir: str) -> None:
+    import inspect
+    import torch
+    import onnxruntime
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp_dir = f"{model_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    print(f"📦 Exporting {model_name} to ONNX with int8 weights, this only happens once...")
+    tokenizer = AutoTokenizer.from_pretrained(hub_model_id(model_name))
+    tokenizer.save_pretrained(tmp_dir)
+    model = AutoModel.from_pretrained(hub_model_id(model_name)).eval()
+    sample = tokenizer(["an example sentence to trace the model with"], return_tensors="pt")
+    #inputs are passed by position, so in the order of forward's parameters, not the tokenizer's
+    #(bert tokenizers return token_type_ids before attention_mask, forward takes them the other way round)
+    input_names = [name for name in inspect.signature(model.forward).parameters if name in sample]
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(sample[name] for name in input_names), os.path.join(tmp_dir, FP32_FILE),
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]},
+            opset_version=14,
+        )
+        expected = model(**sample).last_hidden_state.numpy()
+    session = onnxruntime.InferenceSession(os.path.join(tmp_dir, FP32_FILE), providers=["CPUExecutionProvider"])
+    output = session.run(None, {name: sample[name].numpy() for name in input_names})[0]
+    difference = float(np.abs(output - expected).max())
+    if difference > EXPORT_TOLERANCE:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise RuntimeError(f"ONNX export of {model_name} doesn't match the torch model "
+                           f"(largest difference {difference:.2e}), use --embedding-backend torch")
+    logging.info(f"ONNX export matches the torch model (largest difference {difference:.2e})")
+    quantize_dynamic(os.path.join(tmp_dir, FP32_FILE), os.path.join(tmp_dir, INT8_FILE), weight_type=QuantType.QInt8)
+    shutil.rmtree(model_dir, ignore_errors=True)
+    os.replace(tmp_dir, model_dir)
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence embeddings from an int8 quantized ONNX export of the model, run with onnxruntime on the CPU.
+    Same mean pooling and normalization as the sentence-transformers model, several times faster.
+    Texts are sorted by length and batched, so each batch is only padded to its own longest text.
+    """
+
+    def __init__(self, model_name: str, model_dir: str, batch_size: int = ONNX_BATCH_SIZE,
+                 threads: Optional[int] = None, max_length: int = ONNX_MAX_LENGTH):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        if not os.path.exists(os.path.join(model_dir, INT8_FILE)):
+            export_onnx_model(model_name, model_dir)
+        self.model_dir = model_dir
+        self.batch_size = max(1, batch_size)
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, INT8_FILE), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)
+        lengths = [len(ids) for ids in encoded["input_ids"]]
+        order = np.argsort(lengths, kind="stable")
+        vectors = None
+        pad_id = self.tokenizer.pad_token_id or 0
+        for start in range(0, len(texts), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            longest = lengths[rows[-1]]
+            feeds = {}
+            for name in self.input_names:
+                batch = np.full((len(rows), longest), pad_id if name == "input_ids" else 0, dtype=np.int64)
+                for j, i in enumerate(rows):
+                    batch[j, :lengths[i]] = encoded[name][i]
+                feeds[name] = batch
+            hidden = self.session.run(["last_hidden_state"], feeds)[0]
+            #mean over the real tokens, then unit length, like the sentence-transformers pipeline
+            mask = feeds["attention_mask"][:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            if vectors is None:
+                vectors = np.empty((len(texts), pooled.shape[1]), dtype=np.float32)
+            vectors[rows] = pooled
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+
+#how well candidate vectors keep the nearest neighbours of the reference vectors of the same texts
+#recall: share of every text's RECALL_K nearest texts under reference that are also nearest under candidate
+#cosine: mean cosine similarity between the two vectors of each text
+def neighbour_recall(reference: np.ndarray, candidate: np.ndarray, k: int = RECALL_K) -> Dict[str, float]:
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    k = min(k, len(reference) - 1)
+    cosine = float(np.mean(np.sum(reference * candidate, axis=1)))
+    if k < 1:
+        return {"recall": 1.0, "cosine": cosine}
+    hits = 0
+    for sims_ref, sims_cand, i in zip(reference @ reference.T, candidate @ candidate.T, range(len(reference))):
+        sims_ref[i] = sims_cand[i] = -np.inf  # a text is not its own neighbour
+        hits += len(set(np.argpartition(-sims_ref, k)[:k]) & set(np.argpartition(-sims_cand, k)[:k]))
+    return {"recall": hits / (k * len(reference)), "cosine": cosine}
+
+
+#compares the int8 model in model_dir with the fp32 embeddings on texts
+#the result is saved in the model folder and reused, so the fp32 model only runs once per export
+#(unless a later check has more texts)
+#returns True if the int8 model is good enough to use
+def check_recall(onnx_embeddings: OnnxEmbeddings, fp32_embeddings: Embeddings, texts: List[str],
+                 min_recall: float = MIN_RECALL) -> bool:
+    recall_path = os.path.join(onnx_embeddings.model_dir, RECALL_FILE)
+    try:
+        with open(recall_path, encoding="utf-8") as f:
+            result = json.load(f)
+    except FileNotFoundError:
+        result = None
+    except Exception as e:
+        logging.error(f"Could not read {recall_path}: {e}")
+        result = None
+    # a later check on more chunks replaces one on a handful
+    if result is None or result.get("samples", 0) < len(texts):
+        print(f"🔍 Checking the int8 model against the fp32 model on {len(texts)} chunks...")
+        reference = np.asarray(fp32_embeddings.embed_documents(texts), dtype=np.float32)
+        candidate = onnx_embeddings._encode(texts)
+        result = {**neighbour_recall(reference, candidate), "samples": len(texts), "k": RECALL_K}
+        with open(recall_path, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+    print(f"🔍 int8 model: recall@{result['k']} {result['recall']:.3f}, mean cosine {result['cosine']:.4f} "
+          f"vs fp32 on {result['samples']} chunks")
+    return result["recall"] >= min_recall
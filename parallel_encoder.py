@@ -0,0 +1,101 @@
+import os
+import weakref
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+#the embedding model of this worker process, loaded once by _init_worker
+_worker_embeddings = None
+#number of cores of the share a process was given, for core_shares where processes can't be pinned
+_CORE_SHARE_ENV = "RAG_CORE_SHARE"
+
+
+#pins this process (and the processes it starts) to cores
+def pin_to_cores(cores: List[int]) -> None:
+    if not cores:
+        return
+    os.environ[_CORE_SHARE_ENV] = str(len(cores))
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError as e:
+            logging.warning(f"Could not pin process to cores {cores}: {e}")
+
+
+#runs once in every worker process: pins it to its share of the cores, caps the threads of the
+#model runtime to that share, then loads the model
+def _init_worker(shares_queue, backend: str) -> None:
+    global _worker_embeddings
+    cores = shares_queue.get()
+    pin_to_cores(cores)
+    threads = str(max(1, len(cores)))
+    # read by torch and numpy when they are first imported, and by the onnx backend
+    os.environ["OMP_NUM_THREADS"] = os.environ["MKL_NUM_THREADS"] = threads
+    os.environ["RAG_EMBED_THREADS"] = threads
+    from get_embedding_function import load_model
+    if backend == "torch":
+        try:
+            import torch
+            torch.set_num_threads(int(threads))
+        except ImportError:
+            pass
+    _worker_embeddings = load_model(backend)
+
+
+def _encode(texts: List[str]) -> np.ndarray:
+    return np.asarray(_worker_embeddings.embed_documents(texts), dtype=np.float32)
+
+
+#splits the cores this process may use into `workers` shares of consecutive cores
+#a process pinned with pin_to_cores (e.g. a shard worker of populate_database.py) splits only its own share
+def core_shares(workers: int) -> List[List[int]]:
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(int(os.environ.get(_CORE_SHARE_ENV) or os.cpu_count() or 1)))
+    return [list(share) for share in np.array_split(cores, workers) if len(share)] or [[]]
+
+
+class ParallelEncoder(Embeddings):
+    """
+    Encodes texts with one copy of the embedding model in each of `workers` processes, every process
+    pinned to its own share of the cores. The texts of a call are sorted by length and cut into one
+    bucket per worker, so each worker pads its batches to texts of about the same length.
+    Vectors are returned in the order of the texts.
+    """
+
+    def __init__(self, workers: int, backend: str):
+        shares = core_shares(workers)
+        self.workers = len(shares)
+        self.backend = backend
+        # spawn: workers must not inherit the parent's threads and half initialized model runtimes
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        for share in shares:
+            queue.put([int(core) for core in share])
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                         initializer=_init_worker, initargs=(queue, backend))
+        weakref.finalize(self, self._pool.shutdown, wait=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        buckets = [bucket for bucket in np.array_split(order, self.workers) if len(bucket)]
+        futures = [self._pool.submit(_encode, [texts[i] for i in bucket]) for bucket in buckets]
+        vectors = None
+        for bucket, future in zip(buckets, futures):
+            result = future.result()
+            if vectors is None:
+                vectors = np.empty((len(texts), result.shape[1]), dtype=np.float32)
+            vectors[bucket] = result
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
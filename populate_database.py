@@ -1,11 +1,17 @@
 import asyncio
 import os
 import argparse
+import hashlib
+import json
+import random
 import shutil
 import time
 import logging
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm import tqdm
+from index_manager import index_config as make_index_config
+from chunk_dedup import DEFAULT_THRESHOLD as DEFAULT_DEDUP_THRESHOLD
+from instrumentation import count, span, configure as configure_instrumentation
 from langchain_community.document_loaders import TextLoader, UnstructuredExcelLoader, PyPDFLoader, CSVLoader, \
     Docx2txtLoader
 
@@ -17,6 +23,8 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 #set paths for database and data within our current directory
 FAISS_PATH = os.path.join(BASE_DIR, "faiss")
 DATA_PATH = os.path.join(BASE_DIR, "data")
+#manifest of the files in the index, used by --incremental to find new, changed and removed files
+MANIFEST_FILE = "manifest.json"
 
 #this dictionary sets mapping for file extensions to the loader class name
 LOADER_MAPPING = {
@@ -27,6 +35,13 @@ LOADER_MAPPING = {
     ".csv": "CSVLoader",
     ".docx": "Docx2txtLoader",
 }
+#with the process loader backend, pdfs with more pages than this are split into page ranges
+#of this size and each range is parsed by its own worker process
+PDF_PAGES_PER_TASK = 50
+#tokenizer query.py budgets the prompt context with, chunk token counts are stored with this one
+TOKEN_ENCODING = "cl100k_base"
+#tokenizer the token splitter counts chunk_size and chunk_overlap in
+SPLITTER_ENCODING = "gpt2"
 
 def get_user_inputs():
     #inputting chunk sizes with checks for only valid responses
@@ -77,13 +92,78 @@ def main(cli_args=None):
                        help="Type of text splitter (default: prompt user or token)")
     parser.add_argument("--folder-filter", type=str, default=None,
                        help="Subfolder within data directory to load files from (e.g., 'uae'). Default: load all files in data directory.")
+    parser.add_argument("--loader-backend", type=str, default="thread", choices=["thread", "process"],
+                       help="Parse files in a thread pool or in worker processes. Process is faster for large PDFs (default: thread)")
+    parser.add_argument("--index-type", type=str, default="flat", choices=["flat", "ivf", "hnsw", "ivfpq"],
+                       help="flat is exact search, ivf/hnsw/ivfpq are approximate and much faster on millions of chunks (default: flat)")
+    parser.add_argument("--nlist", type=int, default=None,
+                       help="Number of IVF lists for ivf/ivfpq (default: about 4 * sqrt(number of chunks))")
+    parser.add_argument("--hnsw-m", type=int, default=32, help="Neighbours per node for hnsw (default: 32)")
+    parser.add_argument("--pq-m", type=int, default=16,
+                       help="Sub-quantizers for ivfpq, must divide the embedding size (default: 16)")
+    parser.add_argument("--vector-codec", type=str, default="fp32", choices=["fp32", "fp16", "int8"],
+                       help="How the flat, ivf and hnsw indexes store vectors: fp16 uses half the memory, int8 a quarter, "
+                            "the recall against fp32 is measured and printed (default: fp32)")
+    parser.add_argument("--streaming", action="store_true",
+                       help="Load, split and embed at the same time through bounded queues instead of one stage after the other. Only a few parsed files are held in memory at once.")
+    parser.add_argument("--incremental", action="store_true",
+                       help="Only embed new or changed files and remove deleted ones, keeping the rest of the index. Ignores --reset.")
+    parser.add_argument("--trace", type=str, default=None,
+                       help="Append a JSON line with the duration of every load, split and embed step to this file")
+    parser.add_argument("--metrics-file", type=str, default=None,
+                       help="Write stage timings and counters in Prometheus text format to this file")
+    parser.add_argument("--embedding-backend", type=str, default=None, choices=["torch", "onnx"],
+                       help="torch runs the embedding model in full precision, onnx runs an int8 quantized export of it, "
+                            "several times faster on CPU (default: RAG_EMBEDDING_BACKEND or torch)")
+    parser.add_argument("--embed-batch-size", type=int, default=None,
+                       help="Chunks per embedding model call (default: 64 for onnx, 32 for torch)")
+    parser.add_argument("--embed-threads", type=int, default=None,
+                       help="CPU threads of the onnx backend (default: all cores)")
+    parser.add_argument("--shards", type=str, default=None,
+                       help="Comma separated data folders (or 'all') to build as separate shards in faiss/shards/<folder>, "
+                            "in parallel worker processes. Query one with main.py --shard <folder>")
+    parser.add_argument("--shard-workers", type=int, default=None,
+                       help="Shards built at the same time (default: half the CPU cores, at most one per shard)")
+    parser.add_argument("--embed-workers", type=int, default=None,
+                       help="Embed in this many worker processes, each with its own copy of the model pinned to "
+                            "a share of the cores (default: 1, embed in this process)")
+    parser.add_argument("--dedup", type=float, nargs="?", const=DEFAULT_DEDUP_THRESHOLD, default=None, metavar="THRESHOLD",
+                       help="Drop chunks that are near copies of another chunk (e.g. articles repeated by amendments and "
+                            f"consolidated versions) before embedding them, at this similarity (default: {DEFAULT_DEDUP_THRESHOLD})")
     args = parser.parse_args(cli_args)
+    configure_instrumentation(trace_file=args.trace, metrics_file=args.metrics_file)
+    #exported so get_embedding_function picks them up everywhere, including worker processes
+    if args.embedding_backend:
+        os.environ["RAG_EMBEDDING_BACKEND"] = args.embedding_backend
+    if args.embed_batch_size:
+        os.environ["RAG_EMBED_BATCH_SIZE"] = str(args.embed_batch_size)
+    if args.embed_threads:
+        os.environ["RAG_EMBED_THREADS"] = str(args.embed_threads)
+    if args.embed_workers:
+        os.environ["RAG_EMBED_WORKERS"] = str(args.embed_workers)
     chunk_size = args.chunk_size
     chunk_overlap = args.chunk_overlap
     splitter_type = args.splitter_type
     folder_filter = args.folder_filter
-    if chunk_size is None or chunk_overlap is None or splitter_type is None or folder_filter is None:
+    #with shards the folders are given, only ask for the chunking settings that are missing
+    if chunk_size is None or chunk_overlap is None or splitter_type is None or (folder_filter is None and not args.shards):
         chunk_size, chunk_overlap, splitter_type, folder_filter = get_user_inputs()
+    index_config = make_index_config(args.index_type, nlist=args.nlist, hnsw_m=args.hnsw_m, pq_m=args.pq_m,
+                                     vector_codec=args.vector_codec)
+
+    if args.shards:
+        folders = shard_folders(args.shards)
+        build_shards(folders, args, chunk_size, chunk_overlap, splitter_type, index_config, args.shard_workers)
+        return
+    populate(args, chunk_size, chunk_overlap, splitter_type, folder_filter, index_config)
+
+#builds the index of folder_filter (all of DATA_PATH without one) in FAISS_PATH
+def populate(args, chunk_size, chunk_overlap, splitter_type, folder_filter, index_config):
+    # Incremental update keeps the existing index
+    if args.incremental:
+        update_database(folder_filter, chunk_size, chunk_overlap, splitter_type, args.loader_backend, index_config,
+                        args.dedup)
+        return
 
     # Reset database if requested
     if args.reset:
@@ -92,10 +172,15 @@ def main(cli_args=None):
         clear_database()
         #print("✅ Database reset.")
 
+    if args.streaming:
+        stream_ingest(folder_filter, chunk_size, chunk_overlap, splitter_type, args.loader_backend, index_config,
+                      dedup=args.dedup)
+        return
+
 #loading documents
     print("📄 Loading documents...")
     start = time.time()
-    documents = load_documents_parallel(folder_filter)
+    documents = load_documents_parallel(folder_filter, args.loader_backend)
     print(f"✅ Loaded {len(documents)} documents in {time.time() - start:.2f}s.")
 
     #if documents is an empty list, exit the program
@@ -107,19 +192,476 @@ def main(cli_args=None):
     print("✂️ Splitting documents into chunks...")
     chunks = split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap, splitter_type=splitter_type)
     print(f"✅ Split into {len(chunks)} chunks.")
+    chunks = dedup_chunks(chunks, args.dedup)
 
 #adding chunks to database
     print("📦 Adding chunks to database. This may take a while...")
     start = time.time()
-    add_to_db(chunks)
+    params = chunking_params(chunk_size, chunk_overlap, splitter_type, folder_filter, index_config, args.dedup)
+    add_to_db(chunks, manifest=build_manifest(params, scan_files(folder_filter), chunks), index_config=index_config)
     print(f"✅ Database updated in {time.time() - start:.2f}s.")
 #Finished
 
+#the data folders named in --shards, "all" is every folder in DATA_PATH
+def shard_folders(shards):
+    if shards.strip().lower() == "all":
+        return sorted(f for f in os.listdir(DATA_PATH) if os.path.isdir(os.path.join(DATA_PATH, f)))
+    return [folder.strip() for folder in shards.split(",") if folder.strip()]
+
+#runs once in every shard worker process: pins it to its share of the cores, so with --embed-workers
+#the encoder processes of a shard split that share instead of every shard using all the cores
+def _init_shard_worker(shares_queue):
+    from parallel_encoder import pin_to_cores
+    pin_to_cores(shares_queue.get())
+
+#runs in a worker process: builds one folder into its own shard with the normal pipeline,
+#FAISS_PATH is pointed at the shard so every step (reset, incremental, save) only touches it
+def build_shard(folder, faiss_path, args, chunk_size, chunk_overlap, splitter_type, index_config, threads):
+    global FAISS_PATH
+    from index_manager import read_index_version, shard_path
+    FAISS_PATH = shard_path(faiss_path, folder)
+    #the embedding model of each worker only gets its share of the cores, unless --embed-threads says otherwise
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+    os.environ.setdefault("RAG_EMBED_THREADS", str(threads))
+    start = time.time()
+    populate(args, chunk_size, chunk_overlap, splitter_type, folder, index_config)
+    stamp = read_index_version(FAISS_PATH) or {}
+    return {"chunks": stamp.get("chunks", 0), "seconds": time.time() - start}
+
+#builds every folder into faiss/shards/<folder>, workers shards at a time in worker processes
+#a shard that fails doesn't stop the others, returns the folders that were built
+def build_shards(folders, args, chunk_size, chunk_overlap, splitter_type, index_config, workers=None):
+    import multiprocessing
+    from concurrent.futures import as_completed
+    from parallel_encoder import core_shares
+    missing = [folder for folder in folders if not os.path.isdir(os.path.join(DATA_PATH, folder))]
+    for folder in missing:
+        logging.error(f"Data folder '{folder}' does not exist, skipping its shard")
+    folders = [folder for folder in folders if folder not in missing]
+    if not folders:
+        print("⚠️ No folders to build shards for. Exiting.")
+        return []
+    cores = os.cpu_count() or 1
+    workers = max(1, min(workers or cores // 2, len(folders)))
+    print(f"🧩 Building {len(folders)} shards, {workers} at a time...")
+    start = time.time()
+    built = []
+    #every worker process takes one share of the cores, with fewer cores than workers shares are reused
+    shares = core_shares(workers)
+    context = multiprocessing.get_context()
+    shares_queue = context.Queue()
+    for i in range(workers):
+        shares_queue.put([int(core) for core in shares[i % len(shares)]])
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_shard_worker,
+                             initargs=(shares_queue,)) as executor:
+        futures = {executor.submit(build_shard, folder, FAISS_PATH, args, chunk_size, chunk_overlap, splitter_type,
+                                   index_config, max(1, cores // workers)): folder for folder in folders}
+        for future in as_completed(futures):
+            folder = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Failed to build shard {folder}: {e}")
+                continue
+            if not result["chunks"]:
+                logging.error(f"Shard {folder} has no chunks")
+                continue
+            built.append(folder)
+            print(f"✅ Shard {folder}: {result['chunks']} chunks in {result['seconds']:.2f}s")
+    print(f"✅ Built {len(built)}/{len(folders)} shards in {time.time() - start:.2f}s.")
+    return built
+
+#incremental version of main
+#1. compares the files in the data folder against the manifest saved with the index
+#2. deletes the vectors of removed and changed files
+#3. loads, splits and embeds only new and changed files
+#falls back to a full rebuild when there is no manifest or the chunking parameters changed
+def update_database(folder_filter, chunk_size, chunk_overlap, splitter_type, loader_backend="thread",
+                    index_config=None, dedup=None):
+    from get_embedding_function import get_embedding_function
+    from index_manager import load_vectorstore
+
+    start = time.time()
+    params = chunking_params(chunk_size, chunk_overlap, splitter_type, folder_filter, index_config, dedup)
+    manifest = load_manifest()
+    files = scan_files(folder_filter)
+    if manifest is None or manifest.get("params") != params:
+        print("🔄 No manifest for these chunking parameters, rebuilding the whole database...")
+        clear_database()
+        manifest = {"params": params, "files": {}}
+        vectorstore = None
+    else:
+        try:
+            vectorstore = load_vectorstore(FAISS_PATH, get_embedding_function(), mmap=False)
+        except Exception as e:
+            logging.error(f"Could not load existing database, rebuilding: {e}")
+            clear_database()
+            manifest = {"params": params, "files": {}}
+            vectorstore = None
+
+    #sort files into unchanged and changed, a file whose size and mtime are the same is not re-hashed
+    old_files = manifest["files"]
+    new_files, changed = {}, []
+    for rel_path, info in files.items():
+        entry = old_files.get(rel_path)
+        if entry and entry["size"] == info["size"] and entry["mtime"] == info["mtime"]:
+            new_files[rel_path] = entry
+            continue
+        info["sha256"] = file_hash(info["path"])
+        if entry and entry["sha256"] == info["sha256"]:
+            new_files[rel_path] = {**entry, "mtime": info["mtime"]}
+        else:
+            changed.append(rel_path)
+    removed = [rel_path for rel_path in old_files if rel_path not in files]
+    #a chunk kept for its copies in other files (--dedup) is deleted with its own file,
+    #so the files of the copies are loaded again to put them back
+    stale = {chunk_id for rel_path in changed + removed for chunk_id in old_files.get(rel_path, {}).get("ids", [])}
+    shared = [rel_path for rel_path, entry in new_files.items() if stale.intersection(entry.get("ids", []))]
+    while shared:
+        for rel_path in shared:
+            stale.update(new_files.pop(rel_path).get("ids", []))
+            changed.append(rel_path)
+        shared = [rel_path for rel_path, entry in new_files.items() if stale.intersection(entry.get("ids", []))]
+    print(f"📊 {len(new_files)} unchanged, {len(changed)} new or changed, {len(removed)} removed files.")
+    if not changed and not removed:
+        if new_files != old_files:
+            save_manifest({"params": params, "files": new_files})
+        print("✅ Database is up to date.")
+        return
+
+    #remove vectors of deleted and changed files from the index and docstore
+    #a chunk that stands for copies in several files is listed under each of them
+    stale_ids = list(dict.fromkeys(chunk_id for rel_path in changed + removed
+                                   for chunk_id in old_files.get(rel_path, {}).get("ids", [])))
+    if vectorstore is not None and stale_ids and params["index"]["index_type"] in ("hnsw", "ivf", "ivfpq"):
+        #hnsw graphs can't remove vectors, ivf lists can but don't renumber the ones after them while the
+        #vectorstore does, so its positions would point at the wrong chunks. The whole index has to be rebuilt
+        print(f"🔄 {params['index']['index_type'].upper()} indexes can't delete chunks in place, "
+              f"rebuilding the whole database...")
+        clear_database()
+        return update_database(folder_filter, chunk_size, chunk_overlap, splitter_type, loader_backend, index_config,
+                               dedup)
+    if vectorstore is not None and stale_ids:
+        existing = set(vectorstore.index_to_docstore_id.values())
+        stale_ids = [chunk_id for chunk_id in stale_ids if chunk_id in existing]
+        if stale_ids:
+            vectorstore.delete(stale_ids)
+            logging.info(f"Deleted {len(stale_ids)} chunks")
+
+    chunks = []
+    if changed:
+        print(f"📄 Loading {len(changed)} documents...")
+        documents = asyncio.run(async_load_documents_parallel(folder_filter, only_files=changed,
+                                                              backend=loader_backend))
+        chunks = split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                 splitter_type=splitter_type)
+        print(f"✅ Split into {len(chunks)} chunks.")
+        chunks = dedup_chunks(chunks, dedup)
+        for rel_path, entry in build_manifest(params, {r: files[r] for r in changed}, chunks)["files"].items():
+            new_files[rel_path] = entry
+
+    manifest = {"params": params, "files": new_files}
+    if chunks:
+        add_to_db(chunks, vectorstore=vectorstore, manifest=manifest, index_config=index_config)
+    elif vectorstore is not None and vectorstore.index.ntotal > 0:
+        save_db(vectorstore, manifest)
+    else:
+        #every file was removed, nothing left to index
+        clear_database()
+        save_manifest(manifest)
+    print(f"✅ Database updated in {time.time() - start:.2f}s.")
+
+#the parameters that change the chunks or the index, if any of them changes every file has to be re-embedded
+def chunking_params(chunk_size, chunk_overlap, splitter_type, folder_filter, index_config=None, dedup=None):
+    from get_embedding_function import embedding_backend
+    params = {
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "splitter_type": splitter_type,
+        "folder_filter": folder_filter,
+        "index": index_config or make_index_config("flat"),
+    }
+    #vectors of different backends don't mix, switching rebuilds (torch is left out so older manifests still match)
+    if embedding_backend() != "torch":
+        params["embedding_backend"] = embedding_backend()
+    #left out without --dedup for the same reason
+    if dedup:
+        params["dedup"] = dedup
+    return params
+
+#returns {path relative to DATA_PATH: {path, size, mtime}} for every file that would be loaded
+def scan_files(folder_filter=None):
+    target_path = os.path.join(DATA_PATH, folder_filter) if folder_filter else DATA_PATH
+    if not os.path.isdir(target_path):
+        return {}
+    files = {}
+    for f in os.listdir(target_path):
+        path = os.path.join(target_path, f)
+        if os.path.isfile(path) and os.path.splitext(f)[1].lower() in LOADER_MAPPING:
+            stat = os.stat(path)
+            files[os.path.relpath(path, DATA_PATH)] = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    return files
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+#manifest entry for every file: size, mtime, content hash and the ids of its chunks
+def build_manifest(params, files, chunks=(), ids_by_file=None):
+    ids_by_file = group_ids_by_file(chunks, ids_by_file)
+    entries = {}
+    for rel_path, info in files.items():
+        entries[rel_path] = {
+            "size": info["size"],
+            "mtime": info["mtime"],
+            "sha256": info.get("sha256") or file_hash(info["path"]),
+            "ids": ids_by_file.get(rel_path, []),
+        }
+    return {"params": params, "files": entries}
+
+#adds the ids of chunks to {file relative to DATA_PATH: [ids]}
+#a chunk kept for its near copies (--dedup) is also listed under the files of the copies
+def group_ids_by_file(chunks, ids_by_file=None):
+    ids_by_file = {} if ids_by_file is None else ids_by_file
+    for chunk in chunks:
+        rel_path = os.path.relpath(chunk.metadata.get("source", ""), DATA_PATH)
+        ids_by_file.setdefault(rel_path, []).append(chunk.metadata["id"])
+        add_duplicate_ids(chunk, ids_by_file)
+    return ids_by_file
+
+#lists chunk under the files of the near copies it was kept for, once per file
+def add_duplicate_ids(chunk, ids_by_file):
+    listed = {os.path.relpath(chunk.metadata.get("source", ""), DATA_PATH)}
+    for ref in chunk.metadata.get("duplicates", ()):
+        rel_path = os.path.relpath(str(ref["source"]), DATA_PATH)
+        if rel_path not in listed:
+            listed.add(rel_path)
+            ids_by_file.setdefault(rel_path, []).append(chunk.metadata["id"])
+
+def load_manifest():
+    path = os.path.join(FAISS_PATH, MANIFEST_FILE)
+    if not os.path.exists(path) or not os.path.exists(os.path.join(FAISS_PATH, "faiss.index")):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logging.error(f"Could not read manifest: {e}")
+        return None
+
+def save_manifest(manifest):
+    os.makedirs(FAISS_PATH, exist_ok=True)
+    path = os.path.join(FAISS_PATH, MANIFEST_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(f"{path}.tmp", path)
+
+#streaming version of main, the three stages run at the same time
+#1. load thread parses files (in a thread or process pool) and queues the documents of each file
+#2. split thread splits them and queues chunks in batches of EMBED_BATCH_SIZE
+#3. this thread embeds each batch and adds it to the index
+#the queues are bounded, a stage that gets ahead waits for the next one, so only a few parsed files
+#and chunk batches are held at once instead of every parsed document. The embedded chunks and their
+#vectors still stay in memory until the database is saved at the end
+EMBED_BATCH_SIZE = 500
+STREAM_QUEUE_SIZE = 4
+STREAM_TRAIN_CHUNKS = 20000
+_STREAM_DONE = object()
+
+def stream_ingest(folder_filter, chunk_size, chunk_overlap, splitter_type, loader_backend="thread",
+                  index_config=None, queue_size=STREAM_QUEUE_SIZE, dedup=None):
+    import queue
+    import threading
+    from concurrent.futures import FIRST_COMPLETED, wait
+    from index_manager import resolve_nlist, training_size
+
+    index_config = index_config or make_index_config("flat")
+    params = chunking_params(chunk_size, chunk_overlap, splitter_type, folder_filter, index_config, dedup)
+    files = scan_files(folder_filter)
+    if not files:
+        print("⚠️ No documents found in the specified folder. Exiting.")
+        return
+    doc_queue = queue.Queue(maxsize=queue_size)
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    #exception of a failed stage, raised again in the embedding loop
+    errors = []
+    #items and busy seconds per stage
+    stats = {"load": [0, 0.0], "split": [0, 0.0], "embed": [0, 0.0]}
+    #chunks are compared against every chunk kept from earlier batches, so copies across files are found too
+    deduplicator = None
+    if dedup:
+        from chunk_dedup import ChunkDeduplicator
+        deduplicator = ChunkDeduplicator(dedup)
+
+    #put that gives up when another stage failed, instead of blocking forever
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    #get that returns _STREAM_DONE when a stage failed, its sentinel may never be put
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STREAM_DONE
+
+    def load_stage():
+        executor_class = ProcessPoolExecutor if loader_backend == "process" else ThreadPoolExecutor
+        max_workers = os.cpu_count() or 1
+        paths = sorted((info["path"] for info in files.values()), key=os.path.getsize)
+        try:
+            with executor_class(max_workers=max_workers) as executor:
+                #only a few files are parsed ahead of the splitter
+                in_flight, next_file = {}, 0
+                while (in_flight or next_file < len(paths)) and not stop.is_set():
+                    while next_file < len(paths) and len(in_flight) < max_workers:
+                        in_flight[executor.submit(load_file, paths[next_file])] = time.time()
+                        next_file += 1
+                    done, _ = wait(in_flight, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stats["load"][1] += time.time() - in_flight.pop(future)
+                        try:
+                            documents = future.result()
+                        except Exception as e:
+                            logging.error(f"Error loading file: {e}")
+                            continue
+                        stats["load"][0] += len(documents)
+                        if documents and not put(doc_queue, documents):
+                            return
+        except Exception as e:
+            logging.error(f"Load stage failed: {e}")
+            errors.append(e)
+            stop.set()
+        finally:
+            put(doc_queue, _STREAM_DONE)
+
+    def split_stage():
+        batch = []
+        try:
+            text_splitter = get_text_splitter(chunk_size, chunk_overlap, splitter_type)
+            while True:
+                documents = get(doc_queue)
+                if documents is _STREAM_DONE:
+                    break
+                start = time.time()
+                chunks = split_documents(documents, chunk_size, chunk_overlap, splitter_type, text_splitter)
+                stats["split"][0] += len(chunks)
+                if deduplicator is not None:
+                    chunks = deduplicator.add(chunks)
+                stats["split"][1] += time.time() - start
+                batch.extend(chunks)
+                while len(batch) >= EMBED_BATCH_SIZE:
+                    if not put(chunk_queue, batch[:EMBED_BATCH_SIZE]):
+                        return
+                    batch = batch[EMBED_BATCH_SIZE:]
+            if batch:
+                put(chunk_queue, batch)
+        except Exception as e:
+            logging.error(f"Split stage failed: {e}")
+            errors.append(e)
+            stop.set()
+        finally:
+            put(chunk_queue, _STREAM_DONE)
+
+    print("📄 Streaming documents through load → split → embed...")
+    total_start = time.time()
+    threads = [threading.Thread(target=load_stage, daemon=True), threading.Thread(target=split_stage, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    vectorstore, ids_by_file = None, {}
+    embedding_function = None
+    #ivf indexes are trained on the first chunks, they are held back until there are enough of them
+    #without --nlist the number of lists is picked from up to STREAM_TRAIN_CHUNKS chunks
+    #int8 vectors are scaled to the range of the first chunks the same way
+    if index_config["index_type"] in ("ivf", "ivfpq") and not index_config.get("nlist"):
+        train_chunks = STREAM_TRAIN_CHUNKS
+    else:
+        train_chunks = training_size(index_config)
+    pending, done = [], False
+    try:
+        with tqdm(desc="Embedding chunks", unit="chunk") as progress:
+            while not done:
+                batch = get(chunk_queue)
+                if errors:
+                    raise errors[0]
+                done = batch is _STREAM_DONE
+                if done:
+                    batch = []
+                if vectorstore is None:
+                    #hold batches back until there are enough chunks to train the index on
+                    pending.extend(batch)
+                    if not pending or (len(pending) < train_chunks and not done):
+                        continue
+                    embedding_function = ingest_embedding_function(pending)
+                    index_config = resolve_nlist(index_config, len(pending))
+                    vectorstore = new_vectorstore(embedding_function, index_config, pending)
+                    batch, pending = pending, []
+                if not batch:
+                    continue
+                start = time.time()
+                ids = [chunk.metadata["id"] for chunk in batch]
+                try:
+                    with span("ingest.embed_batch", chunks=len(batch)):
+                        vectorstore.add_documents(batch, ids=ids)
+                except Exception as e:
+                    logging.error(f"Error adding batch of {len(batch)} chunks: {e}")
+                    count("embed_batch_errors")
+                    continue
+                count("chunks_indexed", len(batch))
+                group_ids_by_file(batch, ids_by_file)
+                stats["embed"][0] += len(batch)
+                stats["embed"][1] += time.time() - start
+                progress.update(len(batch))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    #busy time is summed over the workers of a stage, so docs/s is per worker for the load stage
+    for stage, unit in (("load", "documents"), ("split", "chunks"), ("embed", "chunks")):
+        items, busy = stats[stage]
+        rate = items / busy if busy > 0 else 0.0
+        print(f"⏱️ {stage}: {items} {unit}, {busy:.2f}s busy, {rate:.1f} {unit}/s")
+    if vectorstore is None:
+        print("⚠️ No chunks were added. Exiting.")
+        return
+    if deduplicator is not None:
+        #copies can turn up batches after the chunk they are a copy of was added,
+        #so their references are added to the stored chunks at the end
+        for chunk_id, refs in deduplicator.duplicates.items():
+            doc = vectorstore.docstore.search(chunk_id)
+            if hasattr(doc, "metadata"):
+                doc.metadata["duplicates"] = refs
+                add_duplicate_ids(doc, ids_by_file)
+        report_dedup(deduplicator.removed, stats["split"][0])
+    save_db(vectorstore, build_manifest(params, files, ids_by_file=ids_by_file), index_params=index_config)
+    print(f"✅ Database updated in {time.time() - total_start:.2f}s.")
+
 #main function for loading, calls helper functions,
 #1.load_file_batch-processing batches of size 10
 #2.load_single_file-processing single files
 #3.async_load_documents_parallel-parallel processing of batches
-async def async_load_documents_parallel(folder_filter=None):
+#only_files optionally limits loading to these paths, relative to DATA_PATH
+#backend "process" parses in worker processes instead of threads, see load_files_process_pool
+async def async_load_documents_parallel(folder_filter=None, only_files=None, backend="thread"):
+    with span("ingest.load", backend=backend) as load_span:
+        documents = await _load_documents(folder_filter, only_files, backend)
+        load_span.set(documents=len(documents))
+    return documents
+
+async def _load_documents(folder_filter, only_files, backend):
     #if the filter exists use that
     if folder_filter:
         target_path = os.path.join(DATA_PATH, folder_filter)
@@ -135,6 +677,9 @@ async def async_load_documents_parallel(folder_filter=None):
     files = [(f, os.path.getsize(os.path.join(target_path, f)))
              for f in os.listdir(target_path)
              if os.path.isfile(os.path.join(target_path, f))]
+    if only_files is not None:
+        wanted = {os.path.normpath(os.path.join(DATA_PATH, f)) for f in only_files}
+        files = [(f, size) for f, size in files if os.path.normpath(os.path.join(target_path, f)) in wanted]
     if not files:
         logging.warning(f"No files found in {target_path}.")
         return []
@@ -143,6 +688,9 @@ async def async_load_documents_parallel(folder_filter=None):
     # Sort files by size and extension to prioritize smaller/simpler files
     files.sort(key=lambda x: (x[1], os.path.splitext(x[0])[1]))
 
+    if backend == "process":
+        return await load_files_process_pool(files, target_path)
+
     batch_size = 10  # Adjust based on testing
     file_batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
     documents = []
@@ -192,6 +740,30 @@ async def load_single_file(file_path, executor):
     Always offloads to executor to avoid blocking the event loop.
     """
     filename = os.path.basename(file_path)
+    loader_class = get_loader_class(filename)
+    if not loader_class:
+        return []
+
+    #creates running loop
+    loop = asyncio.get_running_loop()
+
+#uses designated loader class
+    #logs success or failure
+    try:
+        logging.info(f"Loading: {filename}")
+        documents = await loop.run_in_executor(executor, load_file, file_path)
+        logging.info(f"Loaded {filename}")
+        count("files_loaded", status="ok")
+        count("pages_loaded", len(documents))
+        return documents
+    except Exception as e:
+        logging.error(f"Error loading {file_path}: {str(e)}")
+        count("files_loaded", status="error")
+        await asyncio.sleep(1)  # wait before retrying
+    return []
+
+#returns the loader class for a file name, None (with a warning) if the type is not supported
+def get_loader_class(filename):
     ext = os.path.splitext(filename)[1].lower()
     loader_class_name = LOADER_MAPPING.get(ext)
 
@@ -206,75 +778,270 @@ async def load_single_file(file_path, executor):
     #if loader_mapping.get returns nothing warns of unsupported file type
     if not loader_class_name:
         logging.warning(f"Unsupported file type: {filename}")
-        return []
+        return None
     loader_class = loader_classes.get(loader_class_name)
     if not loader_class:
         logging.warning(f"Loader class not found for: {filename}")
-        return []
+        return None
+    return loader_class
 
-    #creates running loop
+#process pool version of the loader
+#pypdf text extraction is pure python and holds the GIL, so threads don't help much for PDFs
+#large PDFs are split into page ranges that are parsed by separate worker processes
+#and put back together in page order
+async def load_files_process_pool(files, target_path, pages_per_task=PDF_PAGES_PER_TASK):
     loop = asyncio.get_running_loop()
+    executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+    try:
+        #one list of tasks per file, pdf page ranges are in page order
+        file_tasks = []
+        for file, _ in files:
+            file_path = os.path.join(target_path, file)
+            if not get_loader_class(file):
+                continue
+            num_pages = count_pdf_pages(file_path) if file.lower().endswith(".pdf") else 0
+            if num_pages > pages_per_task:
+                tasks = [loop.run_in_executor(executor, load_pdf_pages, file_path, start,
+                                              min(start + pages_per_task, num_pages))
+                         for start in range(0, num_pages, pages_per_task)]
+            else:
+                tasks = [loop.run_in_executor(executor, load_file, file_path)]
+            file_tasks.append((file_path, tasks))
 
-#uses designated loader class
-    #logs success or failure
+        documents = []
+        for file_path, tasks in file_tasks:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            #a file with a failed page range is skipped entirely rather than indexed with holes
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors:
+                logging.error(f"Error loading {file_path}: {errors[0]}")
+                count("files_loaded", status="error")
+                continue
+            for result in results:
+                documents.extend(result)
+                count("pages_loaded", len(result))
+            count("files_loaded", status="ok")
+            logging.info(f"Loaded {os.path.basename(file_path)}")
+    finally:
+        executor.shutdown(wait=True)
+    return documents
+
+#loads a whole file with its loader class, in a worker thread or process
+def load_file(file_path):
+    loader_class = get_loader_class(file_path)
+    if not loader_class:
+        return []
+    with span("ingest.parse_file", file=os.path.basename(file_path)) as parse_span:
+        documents = loader_class(file_path).load()
+        parse_span.set(pages=len(documents))
+    return documents
+
+def count_pdf_pages(file_path):
+    from pypdf import PdfReader
     try:
-        logging.info(f"Loading: {filename}")
-        loader = loader_class(file_path)
-        documents = await loop.run_in_executor(executor, loader.load)
-        logging.info(f"Loaded {filename}")
-        return documents
+        return len(PdfReader(file_path).pages)
     except Exception as e:
-        logging.error(f"Error loading {file_path}: {str(e)}")
-        await asyncio.sleep(1)  # wait before retrying
-    return []
+        logging.error(f"Could not count pages of {file_path}: {e}")
+        return 0
+
+#runs in a worker process, loads pages [start, end) of a pdf
+#gives the documents the same metadata PyPDFLoader would (source, page, page_label, total_pages...)
+def load_pdf_pages(file_path, start, end):
+    with span("ingest.parse_file", file=os.path.basename(file_path), pages=end - start, first_page=start):
+        return _load_pdf_pages(file_path, start, end)
+
+def _load_pdf_pages(file_path, start, end):
+    from pypdf import PdfReader
+    from langchain_core.documents import Document
+    reader = PdfReader(file_path)
+    doc_metadata = {"producer": "PyPDF", "creator": "PyPDF", "creationdate": ""}
+    for key, value in (reader.metadata or {}).items():
+        doc_metadata[key.lstrip("/").lower()] = str(value)
+    doc_metadata.update({"source": file_path, "total_pages": len(reader.pages)})
+    documents = []
+    for page_number in range(start, end):
+        text = reader.pages[page_number].extract_text()
+        documents.append(Document(
+            page_content=text.strip(),
+            metadata={**doc_metadata, "page": page_number, "page_label": reader.page_labels[page_number]},
+        ))
+    return documents
 
 #synchronous function for loading documents in parallel
-def load_documents_parallel(folder_filter):
+def load_documents_parallel(folder_filter, backend="thread"):
     start = time.time()
     if folder_filter:
         logging.info(f"Loading documents from '{folder_filter}' folder in '{DATA_PATH}'...")
     logging.info("Running load_documents_parallel. This may take a while...")
-    documents = asyncio.run(async_load_documents_parallel(folder_filter))
+    documents = asyncio.run(async_load_documents_parallel(folder_filter, backend=backend))
     logging.info(f"Loaded {len(documents)} documents in {time.time() - start:.2f}s")
     return documents
 
-#splitting into chunks
-def split_documents(documents, chunk_size, chunk_overlap, splitter_type):
+#builds the text splitter for the chosen splitter type
+def get_text_splitter(chunk_size, chunk_overlap, splitter_type):
     from langchain_text_splitters import RecursiveCharacterTextSplitter, CharacterTextSplitter, TokenTextSplitter
+    if splitter_type == "recursive":
+        return RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+            is_separator_regex=False,
+            add_start_index=True,
+        )
+    elif splitter_type == "character":
+        return CharacterTextSplitter(
+            separator="\n\n",
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+            is_separator_regex=False,
+            add_start_index=True,
+        )
+    elif splitter_type == "token":
+        #the splitter's start_index assumes chunk_overlap is in characters, see add_token_start_indexes
+        return TokenTextSplitter(
+            encoding_name=SPLITTER_ENCODING,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+    raise ValueError(f"Unknown splitter type: {splitter_type}")
+
+#splitting into chunks
+def split_documents(documents, chunk_size, chunk_overlap, splitter_type, text_splitter=None):
     try:
-        if splitter_type == "recursive":
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-                length_function=len,
-                is_separator_regex=False,
-            )
-        elif splitter_type == "character":
-            text_splitter = CharacterTextSplitter(
-                separator="\n\n",
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-                length_function=len,
-                is_separator_regex=False,
-            )
-        elif splitter_type == "token":
-            text_splitter = TokenTextSplitter(
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-            )
-        chunks = text_splitter.split_documents(documents)
+        if text_splitter is None:
+            text_splitter = get_text_splitter(chunk_size, chunk_overlap, splitter_type)
+        with span("ingest.split", documents=len(documents)) as split_span:
+            chunks = text_splitter.split_documents(documents)
+            split_span.set(chunks=len(chunks))
+        if splitter_type == "token":
+            add_token_start_indexes(chunks, chunk_overlap)
+        assign_chunk_ids(chunks)
+        with span("ingest.token_counts", chunks=len(chunks)):
+            add_token_counts(chunks)
+        count("chunks_created", len(chunks))
         logging.info(f"Created {len(chunks)} document chunks")
         return chunks
     except Exception as e:
         logging.error(f"Error splitting documents: {e}")
-        return documents
+        return assign_chunk_ids(documents)
+
+#gives every chunk a stable id "<file relative to data>:<page>:<chunk number>"
+#the ids are used as docstore ids so the chunks of one file can be deleted again
+def assign_chunk_ids(chunks):
+    counters = {}
+    for chunk in chunks:
+        source = os.path.relpath(chunk.metadata.get("source", "unknown"), DATA_PATH)
+        page = chunk.metadata.get("page", 0)
+        n = counters.get((source, page), 0)
+        counters[(source, page)] = n + 1
+        chunk.metadata["id"] = f"{source}:{page}:{n}"
+    return chunks
+
+#"start_index" of the chunks of the token splitter. They are windows of the page's tokens, each one
+#repeating the last chunk_overlap tokens of the one before, so a chunk starts where the chunk before
+#it ends minus the text of its own first chunk_overlap tokens. -1 when the text doesn't line up
+#(the chunk text can tokenize differently on its own), query.py then doesn't merge it with the one before
+def add_token_start_indexes(chunks, chunk_overlap):
+    import tiktoken
+    encoding = tiktoken.get_encoding(SPLITTER_ENCODING)
+    previous = {}
+    for chunk in chunks:
+        key = (chunk.metadata.get("source"), chunk.metadata.get("page"))
+        prev = previous.get(key)
+        previous[key] = chunk
+        if prev is None:
+            chunk.metadata["start_index"] = 0
+            continue
+        overlap = encoding.decode(encoding.encode_ordinary(chunk.page_content)[:chunk_overlap]) if chunk_overlap else ""
+        prev_start = prev.metadata.get("start_index", -1)
+        if prev_start < 0 or not prev.page_content.endswith(overlap) or not chunk.page_content.startswith(overlap):
+            chunk.metadata["start_index"] = -1
+        else:
+            chunk.metadata["start_index"] = prev_start + len(prev.page_content) - len(overlap)
+    return chunks
+
+#stores every chunk's token count, and how many of its tokens repeat the end of the chunk before it,
+#in the chunk metadata ("token_count", "overlap_tokens") so query.py can budget the prompt context
+#without tokenizing the chunks again. "start_index" (the chunk's character offset in its page)
+#comes from the splitter (add_token_start_indexes for the token splitter) and tells query.py how
+#much text neighbouring chunks share.
+def add_token_counts(chunks):
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as e:
+        # query.py counts tokens itself for chunks without counts
+        logging.error(f"Could not load tokenizer, chunks are stored without token counts: {e}")
+        return chunks
+    texts = [chunk.page_content for chunk in chunks]
+    for chunk, tokens in zip(chunks, encoding.encode_ordinary_batch(texts)):
+        chunk.metadata["token_count"] = len(tokens)
+
+    #chunks of one page come out of the splitter in order
+    previous = {}
+    overlaps = []
+    for chunk in chunks:
+        key = (chunk.metadata.get("source"), chunk.metadata.get("page"))
+        prev = previous.get(key)
+        previous[key] = chunk
+        start = chunk.metadata.get("start_index", -1)
+        if prev is None or start < 0 or prev.metadata.get("start_index", -1) < 0:
+            continue
+        shared = prev.metadata["start_index"] + len(prev.page_content) - start
+        if shared > 0:
+            overlaps.append((chunk, chunk.page_content[:shared]))
+        else:
+            chunk.metadata["overlap_tokens"] = 0
+    for (chunk, _), tokens in zip(overlaps, encoding.encode_ordinary_batch([text for _, text in overlaps])):
+        chunk.metadata["overlap_tokens"] = len(tokens)
+    return chunks
+
+#with a threshold (--dedup) drops the chunks that are near copies of an earlier chunk, see chunk_dedup.py
+#the chunk that stays lists the id, source and page of its copies in its "duplicates" metadata
+def dedup_chunks(chunks, threshold):
+    if not threshold or not chunks:
+        return chunks
+    from chunk_dedup import ChunkDeduplicator
+    deduplicator = ChunkDeduplicator(threshold)
+    with span("ingest.dedup", chunks=len(chunks)) as dedup_span:
+        kept = deduplicator.add(chunks)
+        dedup_span.set(removed=deduplicator.removed)
+    for chunk in kept:
+        if chunk.metadata["id"] in deduplicator.duplicates:
+            chunk.metadata["duplicates"] = deduplicator.duplicates[chunk.metadata["id"]]
+    report_dedup(deduplicator.removed, len(chunks))
+    return kept
+
+def report_dedup(removed, total):
+    count("chunks_deduplicated", removed)
+    print(f"🧹 Removed {removed} near-duplicate chunks ({removed / total if total else 0:.1%}), {total - removed} left.")
+
+#chunks the onnx backend is checked on against the fp32 model
+RECALL_SAMPLE = 256
+
+#the embedding function for this ingest
+#the onnx backend is checked against the fp32 model on a sample of the chunks first (once per exported
+#model), if it loses too many nearest neighbours this ingest falls back to the torch backend
+def ingest_embedding_function(chunks):
+    from get_embedding_function import check_onnx_recall, embedding_backend, get_embedding_function
+    if embedding_backend() == "onnx":
+        sample = random.Random(0).sample(chunks, min(RECALL_SAMPLE, len(chunks)))
+        try:
+            if not check_onnx_recall([chunk.page_content for chunk in sample]):
+                print("⚠️ The int8 onnx model is not close enough to the fp32 model, using the torch backend instead")
+                os.environ["RAG_EMBEDDING_BACKEND"] = "torch"
+        except Exception as e:
+            # e.g. onnxruntime is not installed
+            logging.error(f"Could not use the onnx embedding backend, using the torch backend instead: {e}")
+            os.environ["RAG_EMBEDDING_BACKEND"] = "torch"
+    return get_embedding_function()
 
 #adding chunks to database
 #longest step
-def add_to_db(chunks):
-    from langchain_community.vectorstores import FAISS
-    from get_embedding_function import get_embedding_function
-    import faiss
+#vectorstore is an already loaded store to add to, otherwise a new one of the type in index_config is created
+def add_to_db(chunks, vectorstore=None, manifest=None, index_config=None):
+    from index_manager import resolve_nlist
     #if split_documents returns empty list, exit the program
     try:
         if not chunks:
@@ -282,35 +1049,139 @@ def add_to_db(chunks):
             return
 #call the embedding function from get_embedding_function.py
         logging.info(f"Adding {len(chunks)} documents")
-        embedding_function = get_embedding_function()
+        embedding_function = ingest_embedding_function(chunks)
 
 #batch size of 500 chunks each about 200 long
         batch_size = 500
-        first_batch = chunks[:batch_size]
-        #initializees database
-        vectorstore = FAISS.from_documents(first_batch, embedding_function)
+        index_params = None
+        if vectorstore is None:
+            #initializees database
+            index_params = resolve_nlist(index_config or make_index_config("flat"), len(chunks))
+            vectorstore = new_vectorstore(embedding_function, index_params, chunks)
+
+        vectors, embedded = encode_chunks(embedding_function, chunks, batch_size)
 
 #uses tpdm as a progress bar to watch
-        for i in tqdm(range(batch_size, len(chunks), batch_size), desc="Adding batches to FAISS"):
-            batch = chunks[i:i + batch_size]
+        for i in tqdm(range(0, len(chunks), batch_size), desc="Adding batches to FAISS"):
+            #chunks whose batch failed to embed are left out
+            batch = [j for j in range(i, min(i + batch_size, len(chunks))) if embedded[j]]
+            if not batch:
+                continue
             try:
-                #aqdds chunks to vector store object
-                vectorstore.add_documents(batch)
+                #aqdds chunks and their vectors to vector store object, in chunk order
+                vectorstore.add_embeddings([(chunks[j].page_content, vectors[j]) for j in batch],
+                                           metadatas=[chunks[j].metadata for j in batch],
+                                           ids=[chunks[j].metadata["id"] for j in batch])
+                count("chunks_indexed", len(batch))
             except Exception as e:
                 logging.error(f"Error adding batch {i // batch_size + 1}: {e}")
+                count("embed_batch_errors")
 
-        #creates folder for database if it doesn't exist
-        os.makedirs(FAISS_PATH, exist_ok=True)
-        faiss.write_index(vectorstore.index, os.path.join(FAISS_PATH, "faiss.index"))
-        vectorstore.save_local(FAISS_PATH)
-        logging.info("Database updated successfully")
+        if getattr(embedding_function, "hits", 0):
+            print(f"♻️ Reused {embedding_function.hits} cached embeddings, computed {embedding_function.misses}.")
+        if index_params is not None and index_params.get("vector_codec") and vectors is not None:
+            index_params = {**index_params, "vector_recall": measure_vector_recall(vectorstore, vectors[embedded],
+                                                                                   index_params["vector_codec"])}
+        save_db(vectorstore, manifest, index_params=index_params)
+        return vectorstore
     except Exception as e:
         logging.error(f"Error in add_to_db: {e}")
 
+#how much a new index with fp16 or int8 vectors loses against an exact search over the fp32 vectors
+#of the same chunks, saved with the index parameters. Only possible while all fp32 vectors are at hand,
+#so --streaming doesn't measure it
+def measure_vector_recall(vectorstore, vectors, codec):
+    from index_manager import RECALL_K, vector_recall
+    if vectorstore.index.ntotal != len(vectors):
+        # a batch failed to add, the positions no longer line up with the vectors
+        return None
+    with span("ingest.vector_recall", codec=codec):
+        recall = vector_recall(vectorstore.index, vectors)
+    dim = vectors.shape[1]
+    print(f"📏 {codec} vectors: recall@{RECALL_K} {recall:.3f} against exact fp32 search, "
+          f"{dim * (2 if codec == 'fp16' else 1)} bytes per vector instead of {dim * 4}")
+    return recall
+
+#embeds the chunks in order of their token count, batch_size at a time, so every encoder batch
+#(and every worker's share of it, see parallel_encoder.py) holds chunks of about the same length
+#and pads little. Returns the vectors in chunk order and a mask of the chunks that were embedded
+def encode_chunks(embedding_function, chunks, batch_size):
+    import numpy as np
+    lengths = [chunk.metadata.get("token_count") or len(chunk.page_content) // 4 for chunk in chunks]
+    order = np.argsort(lengths, kind="stable")
+    vectors, embedded = None, np.zeros(len(chunks), dtype=bool)
+    start = time.time()
+    for i in tqdm(range(0, len(chunks), batch_size), desc="Embedding chunks"):
+        rows = order[i:i + batch_size]
+        try:
+            with span("ingest.embed_batch", batch=i // batch_size + 1, chunks=len(rows)):
+                batch_vectors = np.asarray(embedding_function.embed_documents([chunks[j].page_content for j in rows]),
+                                           dtype=np.float32)
+        except Exception as e:
+            logging.error(f"Error embedding batch {i // batch_size + 1}: {e}")
+            count("embed_batch_errors")
+            continue
+        if vectors is None:
+            vectors = np.zeros((len(chunks), batch_vectors.shape[1]), dtype=np.float32)
+        vectors[rows] = batch_vectors
+        embedded[rows] = True
+    seconds = time.time() - start
+    print(f"⚡ Embedded {int(embedded.sum())} chunks in {seconds:.2f}s "
+          f"({embedded.sum() / seconds if seconds > 0 else 0:.1f} embeddings/s)")
+    return vectors, embedded
+
+#creates an empty vector store with a faiss index of the configured type
+#index types that need training are trained on a random sample of the chunks
+#(those embeddings are cached, so adding the chunks afterwards doesn't embed them twice)
+def new_vectorstore(embedding_function, index_params, chunks):
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from index_manager import build_faiss_index, training_size
+    import numpy as np
+
+    num_train = min(training_size(index_params), len(chunks))
+    sample = random.sample(chunks, num_train) if num_train else chunks[:1]
+    vectors = np.asarray(embedding_function.embed_documents([chunk.page_content for chunk in sample]),
+                         dtype=np.float32)
+    if num_train:
+        print(f"🏋️ Training {index_params['index_type']} index on {num_train} chunks...")
+    with span("ingest.train_index", index_type=index_params["index_type"], chunks=num_train):
+        index = build_faiss_index(vectors.shape[1], index_params, vectors if num_train else None)
+    return FAISS(embedding_function, index, InMemoryDocstore(), {})
+
+#writes the index, docstore, manifest and index parameters to FAISS_PATH
+#faiss.index is memory mapped by query.py and the chunks go to docstore.sqlite, there is no pickle
+def save_db(vectorstore, manifest=None, index_params=None):
+    from index_manager import save_vectorstore, write_index_version, write_index_params
+    from get_embedding_function import embedding_backend
+    with span("ingest.save", chunks=vectorstore.index.ntotal):
+        save_vectorstore(vectorstore, FAISS_PATH)
+    if manifest is not None:
+        #the onnx backend may have fallen back to torch during this ingest
+        manifest["params"].pop("embedding_backend", None)
+        if embedding_backend() != "torch":
+            manifest["params"]["embedding_backend"] = embedding_backend()
+        save_manifest(manifest)
+    if index_params is not None:
+        write_index_params(FAISS_PATH, index_params)
+    #the version stamp goes last, running query processes reload the index when it changes
+    #and embed their questions with the same backend as the chunks
+    write_index_version(FAISS_PATH, chunks=vectorstore.index.ntotal, embedding_backend=embedding_backend())
+    logging.info("Database updated successfully")
+
+#deletes the index in FAISS_PATH, the shards built with --shards in FAISS_PATH/shards are kept
 def clear_database():
+    from index_manager import SHARDS_DIR
     try:
         if os.path.exists(FAISS_PATH):
-            shutil.rmtree(FAISS_PATH)
+            for name in os.listdir(FAISS_PATH):
+                if name == SHARDS_DIR:
+                    continue
+                path = os.path.join(FAISS_PATH, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
             logging.info(f"Deleted database at {FAISS_PATH}")
             print(f"🗑️ Deleted existing database at '{FAISS_PATH}'.")
     except Exception as e:
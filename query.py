@@ -1,14 +1,25 @@
 import os
+import asyncio
+import weakref
+import threading
+import time
 import logging
 import logging.handlers
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Union
+import numpy as np
 import faiss
-from langchain_community.vectorstores import FAISS
 from langchain.prompts import ChatPromptTemplate
 from langchain_ollama import OllamaLLM
+from langchain_core.callbacks import AsyncCallbackHandler
 from get_embedding_function import get_embedding_function
-import tiktoken
-from cachetools import LRUCache
+from index_manager import (IndexManager, read_index_version, search_parameters, shard_names, shard_path,
+                           subset_search)
+from sqlite_docstore import source_matches
+from bm25_index import BM25_FILE, load_bm25_index, reciprocal_rank_fusion
+from answer_cache import AnswerCache
+from llm_scheduler import LLMScheduler
+from search_batcher import SearchBatcher
+from instrumentation import count, span
 
 # --- CONFIGURATION ---
 #setting base director and faiss path
@@ -17,10 +28,11 @@ FAISS_PATH = os.path.join(BASE_DIR, "faiss")
 #allows us to use faiss
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
-#what is sent to the llm prior to the question, important for best results
-PROMPT_TEMPLATE = """
-{question}
-Assume you are a legal expert codifying central bank legislation. Answer the following question exclusively based on the set of legislative documents enacted up to and including YEAR. Documents relevant to this query follow the filename pattern ISO2CODE_CBL_YEAR-MONTH.
+#what is sent to the llm with the question, important for best results
+#the fixed instructions come first and the context and question last, so every prompt starts with
+#the same text and ollama can reuse its evaluation of it instead of prefilling it for every question
+PROMPT_PREFIX = """
+Assume you are a legal expert codifying central bank legislation. Answer the question at the end exclusively based on the set of legislative documents enacted up to and including YEAR. Documents relevant to this query follow the filename pattern ISO2CODE_CBL_YEAR-MONTH.
 Instructions:
 • Respond directly to the specific  question.
 • Your first sentence must clearly state only the correct option from the provided multiple-choice answers.
@@ -29,148 +41,623 @@ Instructions:
 • Do not include additional advice, explanations beyond necessary citations, or external information.
 • If you do not have the explicit answer to the question provided in the context, answer "I don't know.
 
-Context retrieved from relevant documents:
+"""
+PROMPT_TEMPLATE = PROMPT_PREFIX + """Context retrieved from relevant documents:
 
 {context}
 
 ---
 
+Question:
+{question}
 """
+_prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+
+# ollama options sent with every request
+# how long the model stays loaded after a request, so the next question doesn't wait for it to load
+LLM_KEEP_ALIVE = os.environ.get("RAG_LLM_KEEP_ALIVE", "30m")
+# context window in tokens, None for the server default. It must hold the whole prompt:
+# ollama cuts longer prompts from the start, which also throws away the reusable prefix
+LLM_NUM_CTX = int(os.environ["RAG_LLM_NUM_CTX"]) if os.environ.get("RAG_LLM_NUM_CTX") else None
 
 logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
 handler = logging.handlers.MemoryHandler(capacity=100, target=logging.StreamHandler())
 logging.getLogger().addHandler(handler)
-DB_INSTANCE = None
-query_cache = LRUCache(maxsize=100)
-tokenizer = tiktoken.get_encoding("cl100k_base")
-
-# Initialize FAISS index
-try:
-    if os.path.exists(FAISS_PATH):
-        faiss.omp_set_num_threads(6)
-        DB_INSTANCE = FAISS.load_local(
-            FAISS_PATH,
-            embeddings=get_embedding_function(),
-            allow_dangerous_deserialization=True
-        )
-        logging.info("FAISS DB loaded successfully.")
-    else:
-        logging.error(f"FAISS DB not found at {FAISS_PATH}. Ensure populate_database.py has been run.")
-except Exception as e:
-    logging.error(f"Failed to load FAISS index: {e}")
+# loaded on first use, only needed for chunks stored without a token count
+_tokenizer = None
+
+# FAISS index handle, loaded on first use and swapped for the new one
+# whenever populate_database.py writes a new version of the index
+INDEX_MANAGER = IndexManager(FAISS_PATH, embedding_factory=lambda: index_embedding_function())
+# answers are kept on disk and shared between runs, looked up by how similar the question is
+# entries belong to one index version, so answers from an old corpus are never returned
+# RAG_ANSWER_CACHE_THRESHOLD sets how similar a question has to be to reuse an answer (default 0.97)
+ANSWER_CACHE = AnswerCache(os.path.join(BASE_DIR, "answer_cache", "answers.sqlite"),
+                           threshold=float(os.environ.get("RAG_ANSWER_CACHE_THRESHOLD", "0.97")))
+# limits the llm requests in flight across every query_rag call of this process
+# set it to what the ollama server can run in parallel (OLLAMA_NUM_PARALLEL)
+LLM_SCHEDULER = LLMScheduler(max_concurrency=int(os.environ.get("RAG_LLM_CONCURRENCY", "4")))
+# groups the query embeddings and FAISS searches of concurrent query_rag calls into one encoder call
+# and one search. query_server.py gives it a few milliseconds of window to collect requests
+SEARCH_BATCHER = SearchBatcher()
+# one client per model, reused by every query
+# the async http client inside is tied to its event loop, so they are kept per loop
+_llm_clients = weakref.WeakKeyDictionary()
+# BM25 index of every loaded database, read on its first hybrid search
+_bm25_indexes = weakref.WeakKeyDictionary()
+# hybrid search fuses this many vector and BM25 candidates (at least k) down to k
+HYBRID_CANDIDATES = 20
+# folders built with populate_database.py --shards each have their own index, their handles are
+# created on first use and kept like INDEX_MANAGER
+_shard_managers: Dict[str, IndexManager] = {}
+# one embedding function per backend, shared by every shard
+_embedding_functions = {}
+_shards_lock = threading.Lock()
+# shard name that searches every shard and merges the hits
+ALL_SHARDS = "all"
 
 # --- FUNCTIONS ---
 #1. returns database, raises error if one not found
-def get_db():
-    if DB_INSTANCE is None:
-        raise FileNotFoundError(f"FAISS DB not initialized. Ensure {FAISS_PATH} contains valid index files.")
-    return DB_INSTANCE
+#shard picks the index of one data folder built with populate_database.py --shards, None the single index
+def get_db(shard: Optional[str] = None):
+    return get_index_manager(shard).get()
+#the handle of a shard's index, or INDEX_MANAGER without a shard
+def get_index_manager(shard: Optional[str] = None) -> IndexManager:
+    if shard is None:
+        return INDEX_MANAGER
+    with _shards_lock:
+        if shard not in _shard_managers:
+            path = shard_path(FAISS_PATH, shard)
+            if not os.path.isdir(path):
+                raise FileNotFoundError(f"No shard {shard!r} in {FAISS_PATH}, "
+                                        f"build it with populate_database.py --shards {shard}")
+            _shard_managers[shard] = IndexManager(path, embedding_factory=lambda: index_embedding_function(path))
+        return _shard_managers[shard]
+#the databases a query searches and their combined version (for the answer cache)
+#ALL_SHARDS gives every shard, any other shard just that one, None the single index
+def get_dbs(shard: Optional[str] = None):
+    names = shard_names(FAISS_PATH) if shard == ALL_SHARDS else [shard]
+    if not names:
+        raise FileNotFoundError(f"No shards in {FAISS_PATH}, build them with populate_database.py --shards")
+    managers = [get_index_manager(name) for name in names]
+    dbs = [manager.get() for manager in managers]
+    return dbs, "+".join(str(manager.version) for manager in managers)
+#questions are embedded with the backend the index was built with (populate_database.py --embedding-backend)
+def index_embedding_function(faiss_path: Optional[str] = None):
+    stamp = read_index_version(faiss_path or FAISS_PATH) or {}
+    backend = stamp.get("embedding_backend")
+    with _shards_lock:
+        if backend not in _embedding_functions:
+            _embedding_functions[backend] = get_embedding_function(backend=backend)
+        return _embedding_functions[backend]
+#returns the shared client for model_name, creating it on first use
+def get_llm(model_name: str) -> OllamaLLM:
+    clients = _llm_clients.setdefault(asyncio.get_running_loop(), {})
+    if model_name not in clients:
+        # the server address comes from OLLAMA_HOST, like the ollama cli
+        clients[model_name] = OllamaLLM(model=model_name, keep_alive=LLM_KEEP_ALIVE, num_ctx=LLM_NUM_CTX)
+    return clients[model_name]
 #2 returns the number of tokens in a text for counting
 def count_tokens(texts: List[str]) -> List[int]:
-    return [len(tokenizer.encode(text)) for text in texts]  # Approximation
-#3 query rag, main thing
+    global _tokenizer
+    if _tokenizer is None:
+        import tiktoken
+        _tokenizer = tiktoken.get_encoding("cl100k_base")
+    return [len(tokens) for tokens in _tokenizer.encode_ordinary_batch(list(texts))]  # Approximation
+#token counts of the chunks, stored at ingest by populate_database, counted here only for older chunks
+def chunk_token_counts(docs) -> List[int]:
+    counts = [doc.metadata.get("token_count") for doc in docs]
+    missing = [i for i, n_tokens in enumerate(counts) if n_tokens is None]
+    if missing:
+        for i, n_tokens in zip(missing, count_tokens([docs[i].page_content for i in missing])):
+            counts[i] = n_tokens
+    return counts
+#3 builds the context string and source list out of the search results
+#chunks are packed into max_context_length tokens by relevance per token (see pack_context), so a
+#chunk that doesn't fit no longer stops smaller ones further down from being used.
+#Neighbouring chunks of the same page are merged into one span without the text they overlap by.
+#returns the chunks used, their sources, the context text and the packing stats
+def build_context(results, max_context_length: int, show_chunks: bool = False):
+    spans, packing = pack_context(results, max_context_length)
+    context_chunks = [(doc, score) for chunk_span in spans for doc, score in chunk_span["chunks"]]
+
+    #retrivesw chunk source metadata
+    if show_chunks:
+        for i, chunk_span in enumerate(spans, start=1):
+            doc = chunk_span["chunks"][0][0]
+            source = doc.metadata.get("source", "Unknown")
+            page = doc.metadata.get("page", "Unknown")
+            info_msg = f"Chunk {i} - Source: {source}, Page: {page} ({len(chunk_span['chunks'])} merged)"
+            logging.info(info_msg)
+            print(f"\n{info_msg}")
+            print(f"Content: {chunk_span['text'][:200]}...")
+
+    # Join context spans into a single string for the LLM
+    context_texts = [chunk_span["text"] for chunk_span in spans]
+    # Format sources as a string and append to context
+    sources = [
+        {
+            "id": doc.metadata.get("id", "Unknown"),
+            "source": doc.metadata.get("source", "Unknown"),
+            "page": doc.metadata.get("page", "Unknown"),
+            #other places with (nearly) the same text, see populate_database.py --dedup
+            "duplicates": [{"source": ref.get("source", "Unknown"), "page": ref.get("page", "Unknown")}
+                           for ref in doc.metadata.get("duplicates", [])],
+        }
+        for doc, score in context_chunks
+    ]
+    # Create a formatted string for sources, one per span
+    sources_text = "\n".join(
+        f"Source {i}: {source_label(span['chunks'][0][0].metadata)}"
+        + "".join(f", also in {source_label(ref)}" for ref in span["chunks"][0][0].metadata.get("duplicates", []))
+        for i, span in enumerate(spans, 1)
+    )
+    context_texts.append(f"\nSources:\n{sources_text}")
+    full_context_text = "\n\n---\n\n".join(context_texts)
+    return context_chunks, sources, full_context_text, packing
+
+#"<file name> (Page <page>)" of a chunk's metadata or a reference to one of its copies
+def source_label(metadata: Dict) -> str:
+    return f"{os.path.basename(str(metadata.get('source', 'Unknown')))} (Page {metadata.get('page', 'Unknown')})"
+
+#(source and page, chunk number) out of the chunk id "<source>:<page>:<n>", None without an id
+def chunk_sequence(doc):
+    prefix, _, n = str(doc.metadata.get("id", "")).rpartition(":")
+    if not prefix or not n.isdigit():
+        return None
+    return prefix, int(n)
+
+#the text chunk b repeats from the end of chunk a and its token count, from the offsets and counts
+#stored at ingest. ("", 0) if they don't overlap or weren't stored (older databases), the chunks are
+#then joined whole
+def chunk_overlap(a, b):
+    a_start, b_start = a.metadata.get("start_index", -1), b.metadata.get("start_index", -1)
+    if a_start < 0 or b_start < 0 or "overlap_tokens" not in b.metadata:
+        return "", 0
+    shared = a_start + len(a.page_content) - b_start
+    if shared <= 0:
+        return "", 0
+    return b.page_content[:shared], b.metadata["overlap_tokens"]
+
+#3a chooses which search results go into the prompt
+#a. every chunk is worth 1 / rank, results come best first whether scores are distances or fusion scores
+#b. chunks are added by worth per token until nothing else fits in max_context_length (the usual
+#   greedy knapsack, falling back to the single best chunk when that is worth more),
+#   a chunk next to an already chosen one (same page, next chunk number) only costs the tokens
+#   it doesn't share with it
+#c. chosen neighbours are merged into one span, spans are ordered by their best ranked chunk
+#returns the spans ({"text", "chunks"}) and the token counts
+def pack_context(results, max_context_length: int):
+    results = list(results)
+    token_lengths = chunk_token_counts([doc for doc, _ in results])
+    sequences = [chunk_sequence(doc) for doc, _ in results]
+    by_sequence = {seq: i for i, seq in enumerate(sequences) if seq is not None}
+
+    # overlap between every pair of neighbouring results, (text, tokens) keyed by the earlier chunk
+    overlaps = {}
+    for i, seq in enumerate(sequences):
+        j = by_sequence.get((seq[0], seq[1] + 1)) if seq is not None else None
+        if j is not None:
+            overlaps[i] = (j, *chunk_overlap(results[i][0], results[j][0]))
+    previous = {j: (i, tokens) for i, (j, _, tokens) in overlaps.items()}
+
+    chosen, used = set(), 0
+    order = sorted(range(len(results)), key=lambda i: (-1.0 / ((i + 1) * max(token_lengths[i], 1)), i))
+    for i in order:
+        cost = token_lengths[i]
+        if i in overlaps and overlaps[i][0] in chosen:
+            cost -= overlaps[i][2]
+        if i in previous and previous[i][0] in chosen:
+            cost -= previous[i][1]
+        if used + cost <= max_context_length:
+            chosen.add(i)
+            used += cost
+    # worth per token can skip a long top chunk for many short weak ones, keep it alone if it's worth more
+    best = next((i for i in range(len(results)) if token_lengths[i] <= max_context_length), None)
+    if best is not None and best not in chosen and sum(1.0 / (i + 1) for i in chosen) < 1.0 / (best + 1):
+        chosen, used = {best}, token_lengths[best]
+
+    # merge chosen neighbours into spans
+    spans, removed = [], 0
+    for i in sorted(chosen):
+        if i in previous and previous[i][0] in chosen:
+            continue  # part of the span started by an earlier chunk
+        members, text = [i], results[i][0].page_content
+        while members[-1] in overlaps and overlaps[members[-1]][0] in chosen:
+            j, overlap_text, overlap_tokens = overlaps[members[-1]]
+            next_text = results[j][0].page_content
+            text = text + next_text[len(overlap_text):] if overlap_text else f"{text}\n{next_text}"
+            removed += overlap_tokens
+            members.append(j)
+        spans.append({"text": text, "chunks": [results[m] for m in members], "rank": min(members)})
+    spans.sort(key=lambda span: span["rank"])
+
+    packing = {
+        "context_tokens": used,
+        "context_budget": max_context_length,
+        "chunks_used": len(chosen),
+        "overlap_tokens_removed": removed,
+    }
+    logging.info(f"Packed {len(chosen)} of {len(results)} chunks into {used}/{max_context_length} tokens "
+                 f"({removed} overlapping tokens removed)")
+    return spans, packing
+
+#4 fills the prompt template with the question and the context
+def format_prompt(query_text: str, full_context_text: str) -> str:
+    return _prompt_template.format(context=full_context_text, question=query_text)
+
+#5 embeds every query in one encoder call
+def embed_queries(db, query_texts: List[str]) -> np.ndarray:
+    return np.asarray(db.embedding_function.embed_documents(list(query_texts)), dtype=np.float32)
+
+#6 runs one FAISS matrix search for all queries, embedding them first unless vectors are given
+#returns one list of (doc, score) pairs per query, same as similarity_search_with_score
+#nprobe / ef_search tune ivf and hnsw indexes for this search only (more = slower but more accurate)
+#with hybrid the vector hits are merged with BM25 keyword hits by reciprocal rank fusion, so chunks
+#with the exact terms of the question ("quorum", "Article 12") rank high even at small k.
+#scores are then fusion scores (higher is better) instead of distances
+def batch_similarity_search(db, query_texts: List[str], k: int = 5,
+                            source_filter: Optional[str] = None,
+                            vectors: Optional[np.ndarray] = None,
+                            nprobe: Optional[int] = None,
+                            ef_search: Optional[int] = None,
+                            hybrid: bool = False) -> List[List]:
+    if not query_texts:
+        return []
+    if vectors is None:
+        vectors = embed_queries(db, query_texts)
+    vectors = np.array(vectors, dtype=np.float32)
+    if getattr(db, "_normalize_L2", False):
+        faiss.normalize_L2(vectors)
+    bm25 = get_bm25_index(db) if hybrid else None
+    fetch_k = max(k, HYBRID_CANDIDATES) if bm25 is not None else k
+    positions = None
+    if source_filter:
+        # only the chunks of the matching sources are searched, so there are k results whenever
+        # the sources have k chunks
+        positions = np.asarray(source_positions(db, source_filter), dtype=np.int64)
+        if not len(positions):
+            logging.warning(f"No chunks match source filter {source_filter!r}")
+            return [[] for _ in query_texts]
+        scores, indices = subset_search(db.index, vectors, positions, fetch_k, nprobe=nprobe, ef_search=ef_search)
+    else:
+        params = search_parameters(db.index, nprobe=nprobe, ef_search=ef_search)
+        if params is not None:
+            scores, indices = db.index.search(vectors, fetch_k, params=params)
+        else:
+            scores, indices = db.index.search(vectors, fetch_k)
+
+    if bm25 is not None:
+        fused_rows = []
+        for query_text, row_indices in zip(query_texts, indices):
+            _, lexical = bm25.search(query_text, fetch_k, allowed=positions)
+            fused = reciprocal_rank_fusion([row_indices, lexical], k)
+            fused_rows.append(([score for _, score in fused], [pos for pos, _ in fused]))
+        scores, indices = zip(*fused_rows)
+
+    all_results = []
+    for row_scores, row_indices in zip(scores, indices):
+        results = []
+        for score, i, doc in zip(row_scores, row_indices, docs_at_positions(db, row_indices)):
+            if i == -1:
+                continue
+            if not hasattr(doc, "page_content"):
+                logging.warning(f"Could not find document for index {i}")
+                continue
+            results.append((doc, float(score)))
+        all_results.append(results)
+    return all_results
+
+#batch_similarity_search over several shards, keeping the best k hits of each query across them
+#vector scores are distances (lower is better), hybrid scores fusion scores (higher is better)
+def search_dbs(dbs, query_texts: List[str], k: int = 5, hybrid: bool = False, **kwargs) -> List[List]:
+    if len(dbs) == 1:
+        return batch_similarity_search(dbs[0], query_texts, k=k, hybrid=hybrid, **kwargs)
+    per_db = [batch_similarity_search(db, query_texts, k=k, hybrid=hybrid, **kwargs) for db in dbs]
+    merged = []
+    for rows in zip(*per_db):
+        hits = [hit for row in rows for hit in row]
+        hits.sort(key=lambda hit: -hit[1] if hybrid else hit[1])
+        merged.append(hits[:k])
+    return merged
+
+#the BM25 index saved with db, None for databases built before it existed
+def get_bm25_index(db):
+    if db not in _bm25_indexes:
+        bm25 = load_bm25_index(os.path.join(getattr(db, "faiss_path", FAISS_PATH), BM25_FILE))
+        if bm25 is None:
+            logging.warning("No BM25 index found, run populate_database.py again for hybrid search")
+        _bm25_indexes[db] = bm25
+    return _bm25_indexes[db]
+
+#returns the chunk stored at every index position (-1 for none)
+#the sqlite docstore fetches them all in one query instead of one lookup per hit
+def docs_at_positions(db, positions):
+    positions = [int(i) for i in positions]
+    if hasattr(db.docstore, "by_positions"):
+        return db.docstore.by_positions(positions)
+    return [db.docstore.search(db.index_to_docstore_id[i]) if i != -1 else None for i in positions]
+
+#index positions of the chunks whose source matches source_filter
+#the sqlite docstore has them indexed by source, file name and folder, older stores are scanned
+def source_positions(db, source_filter: str) -> List[int]:
+    if hasattr(db.docstore, "positions_for_source"):
+        return db.docstore.positions_for_source(source_filter)
+    positions = []
+    for i, doc_id in db.index_to_docstore_id.items():
+        doc = db.docstore.search(doc_id)
+        if not hasattr(doc, "metadata"):
+            continue
+        sources = [doc.metadata.get("source", "")] + [ref.get("source", "") for ref in doc.metadata.get("duplicates", [])]
+        if any(source_matches(str(source), source_filter) for source in sources):
+            positions.append(i)
+    return sorted(positions)
+
+#7 sends the prompt to the llm and times it
+#with on_token the answer is streamed and on_token is called with every piece as ollama produces it
+#returns the full text and the timing metrics. Besides the times measured here, ollama reports
+#how long it spent on the prompt (prefill) and on the answer (generation). prompt_tokens only counts
+#the prompt tokens it evaluated, a low number means the shared prompt prefix was reused.
+async def generate(model, prompt_string: str, on_token: Optional[Callable[[str], None]] = None):
+    start = time.perf_counter()
+    streamed = _TokenTimer(on_token)
+    result = await model.agenerate([prompt_string], callbacks=[streamed])
+    end = time.perf_counter()
+    generation = result.generations[0][0]
+    response_text = generation.text
+    info = generation.generation_info or {}
+
+    first_token_at = streamed.first_token_at
+    # tokens per second is measured over generation only, after the first token arrived
+    if info.get("eval_count") and info.get("eval_duration"):
+        num_tokens = info["eval_count"]
+        tokens_per_second = round(num_tokens / (info["eval_duration"] / 1e9), 2)
+    else:
+        num_tokens = streamed.pieces or (count_tokens([response_text])[0] if response_text else 0)
+        generation_time = end - (first_token_at or start)
+        tokens_per_second = round(num_tokens / generation_time, 2) if generation_time > 0 else None
+    metrics = {
+        "time_to_first_token": round(first_token_at - start, 4) if first_token_at else None,
+        "total_llm_time": round(end - start, 4),
+        "tokens": num_tokens,
+        "tokens_per_second": tokens_per_second,
+        "prompt_tokens": info.get("prompt_eval_count"),
+        "prefill_time": _seconds(info.get("prompt_eval_duration")),
+        "generation_time": _seconds(info.get("eval_duration")),
+        "load_time": _seconds(info.get("load_duration")),
+    }
+    return response_text, metrics
+
+#ollama reports durations in nanoseconds
+def _seconds(nanoseconds):
+    return round(nanoseconds / 1e9, 4) if nanoseconds is not None else None
+
+#passes every streamed piece to on_token and notes when the first one arrived
+class _TokenTimer(AsyncCallbackHandler):
+    def __init__(self, on_token: Optional[Callable[[str], None]] = None):
+        self.on_token = on_token
+        self.first_token_at = None
+        self.pieces = 0
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if not token:
+            return  # the closing message of the stream has no text
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        # ollama streams one token per piece
+        self.pieces += 1
+        if self.on_token is not None:
+            self.on_token(token)
+
+#8 query rag, main thing
 #a. conducts search
 #b. joins chunks into a single string
-#c. sends prompt to llm
+#c. sends prompt to llm, streaming the answer into on_token if given
 #d. gets response from llm
 #e. prints output and sources
+#shard searches the index of one data folder (populate_database.py --shards), ALL_SHARDS searches all of them
 async def query_rag(query_text: str,
                     k: int = 5,
                     model_name: str = "phi3:mini",
                     max_context_length: int = 2000,
                     source_filter: Optional[str] = None,
-                    show_chunks: bool = False) -> Optional[Dict[str, Union[str, List[Dict]]]]:
+                    show_chunks: bool = False,
+                    use_cache: bool = True,
+                    on_token: Optional[Callable[[str], None]] = None,
+                    priority: int = 0,
+                    nprobe: Optional[int] = None,
+                    ef_search: Optional[int] = None,
+                    hybrid: bool = True,
+                    shard: Optional[str] = None) -> Optional[Dict[str, Union[str, List[Dict]]]]:
+    with span("query", k=k, model=model_name, hybrid=hybrid, shard=shard) as query_span:
+        try:
+            # loading, embedding, searching and the cache are blocking work
+            # they run in the default executor so other queries keep going meanwhile
+            loop = asyncio.get_running_loop()
+            #initialize db, or the dbs of every shard searched
+            with span("query.get_db"):
+                dbs, version = await loop.run_in_executor(None, get_dbs, shard)
+            db = dbs[0]
+            # the query is embedded once, for both the cache lookup and the search
+            # concurrent queries are embedded together in one encoder call
+            def embed_batch(texts):
+                with span("query.embed_batch", queries=len(texts)):
+                    return embed_queries(db, texts)
+
+            with span("query.embed"):
+                vectors = (await SEARCH_BATCHER.submit(("embed", db), query_text, embed_batch))[None, :]
+            # Check cache to see if that question (or a rephrasing of it) has been asked
+            # if found the llm is skipped entirely
+            cache_params = f"{source_filter or ''}:{k}:{max_context_length}:{model_name}:{nprobe}:{ef_search}:{hybrid}"
+            if use_cache:
+                with span("query.cache_lookup"):
+                    cached = await loop.run_in_executor(None, ANSWER_CACHE.lookup, vectors[0], version, cache_params,
+                                                        query_text)
+                count("answer_cache", result="hit" if cached is not None else "miss")
+                if cached is not None:
+                    logging.info("Query result cache hit")
+                    query_span.set(cache_hit=True)
+                    if on_token is not None:
+                        on_token(cached["text"])
+                    return cached
+            # Perform similarity search
+            #returns top k results and their scores
+            # concurrent queries with the same search settings share one FAISS search
+            def search_batch(items):
+                texts, rows = zip(*items)
+                with span("query.search_batch", queries=len(texts)):
+                    return search_dbs(dbs, list(texts), k=k, source_filter=source_filter,
+                                      vectors=np.stack(rows), nprobe=nprobe, ef_search=ef_search, hybrid=hybrid)
+
+            with span("query.search", source_filter=bool(source_filter)):
+                results = await SEARCH_BATCHER.submit(("search", tuple(dbs), k, source_filter, nprobe, ef_search, hybrid),
+                                                      (query_text, vectors[0]), search_batch)
+
+            #something wrong with the search
+            if not results:
+                logging.warning("No chunks found. Either empty database or improper embeddings")
+                return None
+
+            with span("query.build_context") as context_span:
+                context_chunks, sources, full_context_text, packing = build_context(results, max_context_length,
+                                                                                    show_chunks)
+                context_span.set(**packing)
+
+            # Create and send prompt to LLM
+            with span("query.format_prompt"):
+                prompt_string = format_prompt(query_text, full_context_text)
+            model = get_llm(model_name)
+            #gets response from llm, waiting for a free slot first
+            try:
+                with span("query.llm") as llm_span:
+                    wait_start = time.perf_counter()
+                    async with LLM_SCHEDULER.slot(priority):
+                        llm_span.set(queue_wait_ms=round((time.perf_counter() - wait_start) * 1000, 3))
+                        response_text, metrics = await generate(model, prompt_string, on_token)
+                    llm_span.set(**metrics)
+            except Exception as e:
+                logging.error(f"LLM invocation failed: {e}")
+                return None
+            count_llm_tokens(metrics)
+
+            if not response_text:
+                logging.warning("Model returned no response.")
+                return None
+            #printing the output and sources
+            #print("🧠 MODEL RESPONSE:\n", response_text)
+
+            #print("\n📚 SOURCES:")
+            #for i, s in enumerate(sources, 1):
+            #    print(f"{i}. {s['source']} (Page {s['page']}")
+
+            response = {"text": response_text, "sources": sources}
+            if use_cache:
+                with span("query.cache_store"):
+                    await loop.run_in_executor(None, ANSWER_CACHE.store, query_text, vectors[0], version,
+                                               cache_params, response)
+            # timings belong to this call only, they are not cached
+            return {**response, "cache_hit": False, "metrics": {**metrics, **packing}}
+
+        except Exception as e:
+            logging.error(f"Query failed: {e}")
+            return None
+
+#tokens sent to and received from the llm, for the instrumentation counters
+def count_llm_tokens(metrics: Dict) -> None:
+    count("llm_requests")
+    count("llm_tokens", metrics.get("prompt_tokens") or 0, direction="in")
+    count("llm_tokens", metrics.get("tokens") or 0, direction="out")
+
+#9 batch version of query_rag for running many questions against the same index (or shard)
+#a. embeds all questions and searches FAISS once for the whole set
+#b. builds every prompt
+#c. sends the prompts to the llm, at most max_concurrency of this batch at a time
+#   (and within the process wide LLM_SCHEDULER limit)
+#returns a list of responses in the same order as queries (None where a query failed)
+#on_answer(i, response) is called as soon as the answer to queries[i] is there, e.g. to save it right away
+async def query_rag_batch(queries: List[str],
+                          k: int = 5,
+                          model_name: str = "phi3:mini",
+                          max_context_length: int = 2000,
+                          source_filter: Optional[str] = None,
+                          show_chunks: bool = False,
+                          max_concurrency: int = 4,
+                          use_cache: bool = True,
+                          priority: int = 0,
+                          nprobe: Optional[int] = None,
+                          ef_search: Optional[int] = None,
+                          hybrid: bool = True,
+                          shard: Optional[str] = None,
+                          on_answer: Optional[Callable[[int, Dict], None]] = None
+                          ) -> List[Optional[Dict[str, Union[str, List[Dict]]]]]:
+    responses: List[Optional[Dict]] = [None] * len(queries)
+    if not queries:
+        return responses
+    loop = asyncio.get_running_loop()
     try:
-        #initialize db
-        db = get_db()
-        # Check cache to see if that question has been asked
-        # if found time is reduced by 60-80%
-        cache_key = f"{query_text}:{source_filter or ''}:{k}:{max_context_length}:{model_name}"
-        if cache_key in query_cache:
-            logging.info("Query result cache hit")
-            return query_cache[cache_key]
-        #creates filter
-        if source_filter:
-            filter_dict = {"source": source_filter}
-        else:
-            filter_dict = None
-        # Perform similarity search
-        #returns top k results and their scores
-        results = db.similarity_search_with_score(query_text, k=k, filter=filter_dict)
+        with span("query_batch.get_db"):
+            dbs, version = await loop.run_in_executor(None, get_dbs, shard)
+        db = dbs[0]
+        with span("query_batch.embed", queries=len(queries)):
+            vectors = await loop.run_in_executor(None, embed_queries, db, queries)
+        # answer what we can from the cache, only the rest is searched
+        # batch questions can differ in a single article number, so only the same question reuses an answer
+        cache_params = f"{source_filter or ''}:{k}:{max_context_length}:{model_name}:{nprobe}:{ef_search}:{hybrid}"
+        if use_cache:
+            with span("query_batch.cache_lookup", queries=len(queries)):
+                responses = await loop.run_in_executor(None, ANSWER_CACHE.lookup_many, vectors, version, cache_params,
+                                                       list(queries), True)
+            hits = sum(response is not None for response in responses)
+            count("answer_cache", hits, result="hit")
+            if on_answer is not None:
+                for i, response in enumerate(responses):
+                    if response is not None:
+                        on_answer(i, response)
+            count("answer_cache", len(queries) - hits, result="miss")
+        pending = [i for i, response in enumerate(responses) if response is None]
+        if not pending:
+            return responses
+
+        with span("query_batch.search", queries=len(pending), k=k, hybrid=hybrid):
+            all_results = await loop.run_in_executor(
+                None, lambda: search_dbs(dbs, [queries[i] for i in pending], k=k,
+                                         source_filter=source_filter, vectors=vectors[pending],
+                                         nprobe=nprobe, ef_search=ef_search, hybrid=hybrid))
+    except Exception as e:
+        logging.error(f"Batch search failed: {e}")
+        return responses
+
+    model = get_llm(model_name)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
 
-        #something wrong with the search
+    async def answer(i, results):
         if not results:
             logging.warning("No chunks found. Either empty database or improper embeddings")
-            return None
-
-        #limits for max context length and number of chunks
-        context_chunks, context_length = [], 0
-        contents = [doc.page_content for doc, _ in results]
-        token_lengths = count_tokens(contents)
-        for (doc, score), token_len in zip(results, token_lengths):
-            if context_length + token_len <= max_context_length:
-                context_chunks.append((doc, score))
-                context_length += token_len
-            else:
-                break
-
-        #retrivesw chunk source metadata
-        if show_chunks:
-            for i, (doc, score) in enumerate(context_chunks, start=1):
-                source = doc.metadata.get("source", "Unknown")
-                page = doc.metadata.get("page", "Unknown")
-                info_msg = f"Chunk {i} - Source: {source}, Page: {page}"
-                logging.info(info_msg)
-                if show_chunks:
-                    print(f"\n{info_msg}")
-                    print(f"Content: {doc.page_content[:200]}...")
-
-        # Join context chunks into a single string for the LLM
-        context_texts = []
-        for doc, _ in context_chunks:
-            context_texts.append(doc.page_content)
-        # Format sources as a string and append to context
-        sources = [
-            {
-                "id": doc.metadata.get("id", "Unknown"),
-                "source": doc.metadata.get("source", "Unknown"),
-                "page": doc.metadata.get("page", "Unknown"),
-            }
-            for doc, score in context_chunks
-        ]
-        # Create a formatted string for sources
-        sources_text = "\n".join(
-            f"Source {i}: {os.path.basename(s['source'])} (Page {s['page']})"
-            for i, s in enumerate(sources, 1)
-        )
-        context_texts.append(f"\nSources:\n{sources_text}")
-        full_context_text = "\n\n---\n\n".join(context_texts)
-
-        # Create and send prompt to LLM
-        prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-        prompt_string = prompt_template.format(context=full_context_text, question=query_text)
-        model = OllamaLLM(model=model_name)
-        #gets response from llm
+            return
         try:
-            response_text = model.invoke(prompt_string)
+            with span("query_batch.build_context") as context_span:
+                _, sources, full_context_text, packing = build_context(results, max_context_length, show_chunks)
+                context_span.set(**packing)
+            prompt_string = format_prompt(queries[i], full_context_text)
+            with span("query_batch.llm") as llm_span:
+                wait_start = time.perf_counter()
+                async with semaphore, LLM_SCHEDULER.slot(priority):
+                    llm_span.set(queue_wait_ms=round((time.perf_counter() - wait_start) * 1000, 3))
+                    response_text, metrics = await generate(model, prompt_string)
+                llm_span.set(**metrics)
         except Exception as e:
             logging.error(f"LLM invocation failed: {e}")
-            return None
-
+            return
+        count_llm_tokens(metrics)
         if not response_text:
             logging.warning("Model returned no response.")
-            return None
-        #printing the output and sources
-        #print("🧠 MODEL RESPONSE:\n", response_text)
-
-        #print("\n📚 SOURCES:")
-        #for i, s in enumerate(sources, 1):
-        #    print(f"{i}. {s['source']} (Page {s['page']}")
-
+            return
         response = {"text": response_text, "sources": sources}
-        query_cache[cache_key] = response
-        return response
+        if use_cache:
+            await loop.run_in_executor(None, ANSWER_CACHE.store, queries[i], vectors[i], version, cache_params, response)
+        responses[i] = {**response, "cache_hit": False, "metrics": {**metrics, **packing}}
+        if on_answer is not None:
+            on_answer(i, responses[i])
 
-    except Exception as e:
-        logging.error(f"Query failed: {e}")
-        return None
+    await asyncio.gather(*(answer(i, results) for i, results in zip(pending, all_results)))
+    return responses
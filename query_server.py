@@ -0,0 +1,179 @@
+import json
+import queue
+import asyncio
+import logging
+import argparse
+import threading
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, Optional
+import instrumentation
+
+#Keeps query.py loaded in one long running process, so the embedding model, the FAISS index,
+#the BM25 index and the tokenizer are loaded once instead of on every main.py run.
+#  python query_server.py                       serves http://127.0.0.1:8765
+#  python main.py --server --query_text "..."   asks it instead of loading everything itself
+#POST /query takes the arguments of query_rag as JSON and answers {"response": ...}, with
+#"stream": true it sends one JSON line per token ({"token": ...}) and the response last.
+#GET /health reports the loaded index, GET /metrics the instrumentation counters.
+#The embeddings and FAISS searches of queries arriving within --batch_window_ms of each other
+#run as one batch (see search_batcher.py).
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_SERVER_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+#query_rag arguments a client may send
+QUERY_FIELDS = {"query_text", "k", "model_name", "max_context_length", "source_filter", "use_cache",
+                "priority", "nprobe", "ef_search", "hybrid", "shard"}
+
+
+#loads the index, the models and the tokenizer, so the first request doesn't pay for them
+def warm_up(query) -> None:
+    db = query.get_db()
+    query.embed_queries(db, ["warm up"])
+    query.get_bm25_index(db)
+    query.count_tokens(["warm up"])
+    print(f"🔥 Loaded index with {db.index.ntotal} chunks")
+
+
+def make_handler(query, loop):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.info("%s - %s", self.address_string(), format % args)
+
+        def _send_json(self, status: int, body: Dict) -> None:
+            data = json.dumps(body, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_line(self, message: Dict) -> None:
+            data = (json.dumps(message, default=str) + "\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/health":
+                try:
+                    db = query.get_db()
+                    self._send_json(200, {"status": "ok", "index_version": query.INDEX_MANAGER.version,
+                                          "chunks": db.index.ntotal})
+                except Exception as e:
+                    self._send_json(503, {"status": "error", "error": str(e)})
+            elif path == "/metrics":
+                data = instrumentation.metrics_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self._send_json(404, {"error": f"Unknown path {path}"})
+
+        def do_POST(self):
+            if self.path.split("?")[0] != "/query":
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stream = bool(request.pop("stream", False))
+                unknown = set(request) - QUERY_FIELDS
+                if unknown:
+                    raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+                if not request.get("query_text"):
+                    raise ValueError("query_text is required")
+            except (ValueError, AttributeError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+
+            if not stream:
+                response = asyncio.run_coroutine_threadsafe(query.query_rag(**request), loop).result()
+                self._send_json(200, {"response": response})
+                return
+
+            # tokens are produced on the event loop thread and written out from this one
+            tokens = queue.Queue()
+            future = asyncio.run_coroutine_threadsafe(query.query_rag(**request, on_token=tokens.put), loop)
+            future.add_done_callback(lambda _: tokens.put(None))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                while (token := tokens.get()) is not None:
+                    self._send_line({"token": token})
+                self._send_line({"response": future.result()})
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # the client went away, stop generating for it
+                future.cancel()
+
+    return Handler
+
+
+#sends one query to the server at server_url and returns the response of query_rag (None if it failed)
+#with on_token the answer is streamed and on_token is called with every piece
+#raises urllib.error.URLError if the server can't be reached
+def remote_query(server_url: str, request: Dict, on_token: Optional[Callable[[str], None]] = None,
+                 timeout: float = 600) -> Optional[Dict]:
+    body = json.dumps({**request, "stream": on_token is not None}).encode("utf-8")
+    http_request = urllib.request.Request(server_url.rstrip("/") + "/query", data=body,
+                                          headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(http_request, timeout=timeout) as http_response:
+        if on_token is None:
+            return json.loads(http_response.read())["response"]
+        for line in http_response:
+            message = json.loads(line)
+            if "token" in message:
+                on_token(message["token"])
+            else:
+                return message["response"]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve query_rag over HTTP with the index and models kept loaded.")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST, help=f"Address to listen on (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--batch_window_ms", type=float, default=5.0,
+                        help="How long to collect concurrent queries into one embedding and search batch (default: 5)")
+    parser.add_argument("--max_batch", type=int, default=32, help="Most queries in one batch (default: 32)")
+    parser.add_argument("--llm_concurrency", type=int, default=None,
+                        help="LLM requests in flight at once (default: RAG_LLM_CONCURRENCY or 4)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    import query
+
+    query.SEARCH_BATCHER.window = args.batch_window_ms / 1000
+    query.SEARCH_BATCHER.max_batch = max(1, args.max_batch)
+    if args.llm_concurrency:
+        query.LLM_SCHEDULER.set_max_concurrency(args.llm_concurrency)
+    try:
+        warm_up(query)
+    except Exception as e:
+        # the server still starts, requests fail until populate_database.py has built an index
+        logging.error(f"Could not load the index: {e}")
+
+    # every query runs on this one loop, so concurrent requests can be batched together
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(query, loop))
+    server.daemon_threads = True
+    print(f"🚀 Serving queries at http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Dict, List, Set
+
+
+#stable id of a question, so reordering or inserting questions doesn't mix up stored answers
+def question_id(question: str) -> str:
+    return hashlib.sha1(question.strip().encode("utf-8")).hexdigest()[:16]
+
+
+class ResultStore:
+    """
+    Answers of the automated run, one row per (folder, question, index version, model, params).
+    Every answer is committed as soon as it arrives, so a crashed or interrupted run loses nothing
+    and a restart only asks the questions that are not done yet. Failed questions are kept with
+    their error and number of attempts until a retry succeeds.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(store_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                folder TEXT NOT NULL,
+                question_id TEXT NOT NULL,
+                index_version TEXT NOT NULL,
+                model TEXT NOT NULL,
+                params TEXT NOT NULL,
+                question_number INTEGER NOT NULL,
+                question TEXT NOT NULL,
+                status TEXT NOT NULL,
+                response TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL,
+                PRIMARY KEY (folder, question_id, index_version, model, params)
+            )""")
+        self._conn.commit()
+
+    #question ids of folder that already have an answer for this index version, model and params
+    def completed(self, folder: str, index_version: str, model: str, params: str) -> Set[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT question_id FROM results WHERE folder = ? AND index_version = ? AND model = ? "
+                "AND params = ? AND status = 'done'", (folder, index_version, model, params)).fetchall()
+        return {row[0] for row in rows}
+
+    def _record(self, folder, index_version, model, params, question_number, question, status,
+                response=None, error=None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO results (folder, question_id, index_version, model, params, question_number, question, "
+                "status, response, error, attempts, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (folder, question_id, index_version, model, params) DO UPDATE SET "
+                "question_number = excluded.question_number, status = excluded.status, "
+                "response = excluded.response, error = excluded.error, attempts = attempts + 1, "
+                "updated = excluded.updated",
+                (folder, question_id(question), index_version, model, params, question_number, question, status,
+                 json.dumps(response) if response is not None else None, error, time.time()))
+            self._conn.commit()
+
+    def record_success(self, folder: str, index_version: str, model: str, params: str,
+                       question_number: int, question: str, response: Dict) -> None:
+        self._record(folder, index_version, model, params, question_number, question, "done", response=response)
+
+    def record_failure(self, folder: str, index_version: str, model: str, params: str,
+                       question_number: int, question: str, error: str) -> None:
+        self._record(folder, index_version, model, params, question_number, question, "failed", error=error)
+
+    #every stored row of folder for this index version, model and params, in question order
+    def results(self, folder: str, index_version: str, model: str, params: str) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT question_number, question, status, response, error, attempts FROM results "
+                "WHERE folder = ? AND index_version = ? AND model = ? AND params = ? ORDER BY question_number",
+                (folder, index_version, model, params)).fetchall()
+        return [{"question_number": number, "question": question, "status": status,
+                 "response": json.loads(response) if response else None, "error": error, "attempts": attempts}
+                for number, question, status, response, error, attempts in rows]
+
+    #writes the text report of folder from the stored answers, replacing the file in one go
+    #returns the number of answered questions written
+    def export_txt(self, output_file: str, folder: str, index_version: str, model: str, params: str) -> int:
+        lines, answered = [], 0
+        for row in self.results(folder, index_version, model, params):
+            if row["status"] != "done":
+                continue
+            answered += 1
+            result = row["response"]
+            lines.append(f"Question {row['question_number']}:\n{row['question']}\n\nResponse: {result['text']}\n")
+            lines.append("\nSources:\n")
+            for j, source in enumerate(result["sources"], 1):
+                # Extract filename from source path
+                source_name = os.path.basename(source["source"]) if source["source"] != "Unknown" else "Unknown"
+                lines.append(f"{j}. {source_name} (Page {source['page']})\n")
+                # the same text in other files, see populate_database.py --dedup
+                for duplicate in source.get("duplicates", []):
+                    lines.append(f"   also in {os.path.basename(str(duplicate['source']))} (Page {duplicate['page']})\n")
+            lines.append("\n")
+        tmp_path = f"{output_file}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, output_file)
+        return answered
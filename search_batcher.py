@@ -0,0 +1,56 @@
+import asyncio
+import weakref
+from typing import Any, Callable, Hashable, List
+
+
+class SearchBatcher:
+    """
+    Groups the work of concurrent queries into one call. Items submitted under the same key within
+    window seconds of the first one are passed together to run_batch, which runs in the default
+    executor and returns one result per item. With window 0 only the queries that arrive in the
+    same event loop iteration (e.g. from asyncio.gather) are grouped, so a single query never waits.
+    """
+
+    def __init__(self, window: float = 0.0, max_batch: int = 32):
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        # loop -> {key: (items, futures, run_batch)} of the batches still collecting
+        self._pending = weakref.WeakKeyDictionary()
+
+    #adds item to the batch of key and waits for its result
+    async def submit(self, key: Hashable, item: Any, run_batch: Callable[[List[Any]], List[Any]]) -> Any:
+        loop = asyncio.get_running_loop()
+        batches = self._pending.setdefault(loop, {})
+        batch = batches.get(key)
+        if batch is None:
+            batch = batches[key] = ([], [], run_batch)
+            loop.call_later(self.window, self._flush, loop, key, batch)
+        items, futures, _ = batch
+        future = loop.create_future()
+        items.append(item)
+        futures.append(future)
+        if len(items) >= self.max_batch:
+            self._flush(loop, key, batch)
+        return await future
+
+    #stops collecting for batch and runs it, called by the window timer or when the batch is full
+    def _flush(self, loop, key, batch) -> None:
+        batches = self._pending.get(loop, {})
+        if batches.get(key) is not batch:
+            return  # already flushed because it was full
+        del batches[key]
+        loop.create_task(self._run(loop, batch))
+
+    async def _run(self, loop, batch) -> None:
+        items, futures, run_batch = batch
+        try:
+            results = await loop.run_in_executor(None, run_batch, items)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            # a caller that was cancelled meanwhile no longer waits for its result
+            if not future.done():
+                future.set_result(result)
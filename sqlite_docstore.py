@@ -0,0 +1,229 @@
+import os
+import json
+import zlib
+import random
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from typing import Dict, List, Union
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+
+#the docstore file written next to faiss.index
+DOCSTORE_FILE = "docstore.sqlite"
+#chunk texts and metadata are stored deflate compressed with one dictionary shared by every row,
+#so the text chunks have in common ("the Governor of the Bank", the source path) costs a few bytes
+#zlib only looks back 32KB, a longer dictionary would not be used
+ZDICT_SIZE = 32768
+#chunks the dictionary is built from
+ZDICT_SAMPLE = 200
+COMPRESSION_LEVEL = 9
+#raw deflate, without the zlib header and checksum of every row
+_WBITS = -15
+
+
+#the shared dictionary: text of a random sample of chunks (at most 1KB of each, so long chunks don't
+#crowd out the others), whatever a chunk shares with them (recurring articles, definitions, boilerplate)
+#is stored as a reference into the dictionary. The metadata of one chunk goes last, where zlib finds
+#matches cheapest, since every row repeats its keys and source
+def build_zdict(texts: List[str], metadata: List[str], size: int = ZDICT_SIZE) -> bytes:
+    tail = metadata[0].encode("utf-8")[:size // 8] if metadata else b""
+    chosen, used = [], len(tail)
+    for text in texts:
+        data = text.encode("utf-8")[:min(size // 32, size - used)]
+        chosen.append(data)
+        used += len(data)
+        if used >= size:
+            break
+    return b"".join(chosen) + tail
+
+
+def compress(data: str, zdict: bytes) -> bytes:
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, _WBITS, zdict=zdict)
+    return compressor.compress(data.encode("utf-8")) + compressor.flush()
+
+
+def decompress(data: bytes, zdict: bytes) -> str:
+    return zlib.decompressobj(_WBITS, zdict=zdict).decompress(data).decode("utf-8")
+
+
+#writes every chunk of an in-memory vector store to a new sqlite docstore
+#rows are keyed by the chunk's position in the faiss index, so a search hit is one indexed lookup
+#the file is written under a temp name and swapped in, processes that have the old one open keep reading it
+def write_sqlite_docstore(path: str, index_to_docstore_id: Dict[int, str], docstore) -> None:
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    doc_ids = list(index_to_docstore_id.values())
+    sample = [docstore.search(doc_id) for doc_id in random.Random(0).sample(doc_ids, min(ZDICT_SAMPLE, len(doc_ids)))]
+    sample = [doc for doc in sample if isinstance(doc, Document)]
+    zdict = build_zdict([doc.page_content for doc in sample],
+                        [json.dumps(doc.metadata, default=str) for doc in sample[:1]])
+    conn = sqlite3.connect(tmp_path)
+    try:
+        #docstores without this table were written before compression and store plain text
+        conn.execute("CREATE TABLE settings (key TEXT PRIMARY KEY, value BLOB)")
+        conn.executemany("INSERT INTO settings VALUES (?, ?)", [("compression", b"deflate"), ("zdict", zdict)])
+        conn.execute("""
+            CREATE TABLE chunks (
+                pos INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                page_content BLOB NOT NULL,
+                metadata BLOB NOT NULL,
+                source TEXT,
+                folder TEXT COLLATE NOCASE,
+                filename TEXT COLLATE NOCASE
+            )""")
+        #the sources of the near copies a chunk was kept for (populate_database.py --dedup),
+        #so a source filter on one of them still finds the chunk
+        conn.execute("""
+            CREATE TABLE duplicate_sources (
+                pos INTEGER NOT NULL,
+                source TEXT,
+                folder TEXT COLLATE NOCASE,
+                filename TEXT COLLATE NOCASE
+            )""")
+        rows, duplicate_rows = [], []
+        insert = "INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)"
+        for pos, doc_id in index_to_docstore_id.items():
+            doc = docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                continue
+            source = str(doc.metadata.get("source", ""))
+            rows.append((int(pos), doc_id, compress(doc.page_content, zdict),
+                         compress(json.dumps(doc.metadata, default=str), zdict), source, os.path.basename(os.path.dirname(source)), os.path.basename(source)))
+            for duplicate in {str(ref.get("source", "")) for ref in doc.metadata.get("duplicates", ())} - {source}:
+                duplicate_rows.append((int(pos), duplicate, os.path.basename(os.path.dirname(duplicate)),
+                                       os.path.basename(duplicate)))
+            if len(rows) >= 10000:
+                conn.executemany(insert, rows)
+                rows = []
+        conn.executemany(insert, rows)
+        conn.executemany("INSERT INTO duplicate_sources VALUES (?, ?, ?, ?)", duplicate_rows)
+        #source -> index positions, so a source filter only searches that source's vectors
+        conn.execute("CREATE INDEX chunks_source ON chunks (source)")
+        conn.execute("CREATE INDEX chunks_folder ON chunks (folder)")
+        conn.execute("CREATE INDEX chunks_filename ON chunks (filename)")
+        conn.execute("CREATE INDEX duplicate_sources_source ON duplicate_sources (source)")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+
+#a source filter matches the full source path, a file name or the start of one
+#(e.g. "SI_CBL" or "SI_CBL_2019" for ISO2CODE_CBL_YEAR-MONTH files), or the data sub-folder
+#names are compared case-insensitively
+def source_matches(source: str, source_filter: str) -> bool:
+    source_filter_lower = source_filter.lower()
+    return (source == source_filter
+            or os.path.basename(source).lower().startswith(source_filter_lower)
+            or os.path.basename(os.path.dirname(source)).lower() == source_filter_lower)
+
+
+class _Connection:
+    #one read-only connection, opened right away and shared by every thread (queries run in executor
+    #threads) one statement at a time. The open file stays the one the index was loaded with, a rebuild
+    #replaces docstore.sqlite before the new version stamp is written and a connection opened later
+    #would read the new chunks at the old index positions
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def fetchone(self, sql: str, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params=()) -> List:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def has_table(self, name: str) -> bool:
+        return self.fetchone("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)) is not None
+
+
+class SQLiteDocstore(Docstore):
+    """Read-only docstore that fetches chunks from docstore.sqlite only when a search returns them."""
+
+    def __init__(self, path: str):
+        self.connection = _Connection(path)
+        # docstores written before --dedup existed don't have the table
+        self._has_duplicate_sources = self.connection.has_table("duplicate_sources")
+        #the shared compression dictionary, b"" for docstores that store plain text
+        self._zdict = b""
+        if self.connection.has_table("settings"):
+            row = self.connection.fetchone("SELECT value FROM settings WHERE key = 'zdict'")
+            self._zdict = row[0] if row else b""
+
+    def _to_document(self, row) -> Document:
+        page_content, metadata = row
+        if isinstance(page_content, bytes):
+            page_content, metadata = decompress(page_content, self._zdict), decompress(metadata, self._zdict)
+        return Document(page_content=page_content, metadata=json.loads(metadata))
+
+    def search(self, search: str) -> Union[str, Document]:
+        row = self.connection.fetchone("SELECT page_content, metadata FROM chunks WHERE id = ?", (search,))
+        if row is None:
+            return f"ID {search} not found."
+        return self._to_document(row)
+
+    #documents at these index positions, None where there is none
+    def by_positions(self, positions: List[int]) -> List[Union[Document, None]]:
+        positions = [int(pos) for pos in positions]
+        if not positions:
+            return []
+        rows = self.connection.fetchall(
+            f"SELECT pos, page_content, metadata FROM chunks WHERE pos IN ({','.join('?' * len(positions))})",
+            positions)
+        found = {pos: self._to_document((page_content, metadata)) for pos, page_content, metadata in rows}
+        return [found.get(pos) for pos in positions]
+
+    #index positions of every chunk whose source, or the source of one of its near copies, matches
+    #source_filter, see source_matches
+    def positions_for_source(self, source_filter: str) -> List[int]:
+        prefix = source_filter.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        match = "WHERE source = ? OR folder = ? OR filename LIKE ? ESCAPE '\\'"
+        sql, params = f"SELECT pos FROM chunks {match}", (source_filter, source_filter, prefix)
+        if self._has_duplicate_sources:
+            sql, params = f"{sql} UNION SELECT pos FROM duplicate_sources {match}", params * 2
+        rows = self.connection.fetchall(f"{sql} ORDER BY pos", params)
+        return [pos for (pos,) in rows]
+
+    #every document, in index order, used to load the store back into memory for updates
+    def iter_all(self):
+        for pos, doc_id, page_content, metadata in self.connection.fetchall(
+                "SELECT pos, id, page_content, metadata FROM chunks ORDER BY pos"):
+            yield pos, doc_id, self._to_document((page_content, metadata))
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        raise NotImplementedError("SQLiteDocstore is read-only, rebuild it with populate_database.py")
+
+    def delete(self, ids: List) -> None:
+        raise NotImplementedError("SQLiteDocstore is read-only, rebuild it with populate_database.py")
+
+
+class SQLiteIndexMap(MutableMapping):
+    """Lazy index position -> docstore id mapping over the docstore's connection (read-only)."""
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self.connection = docstore.connection
+
+    def __getitem__(self, pos):
+        row = self.connection.fetchone("SELECT id FROM chunks WHERE pos = ?", (int(pos),))
+        if row is None:
+            raise KeyError(pos)
+        return row[0]
+
+    def __iter__(self):
+        for (pos,) in self.connection.fetchall("SELECT pos FROM chunks ORDER BY pos"):
+            yield pos
+
+    def __len__(self):
+        return self.connection.fetchone("SELECT COUNT(*) FROM chunks")[0]
+
+    def __setitem__(self, pos, doc_id):
+        raise NotImplementedError("SQLiteIndexMap is read-only")
+
+    def __delitem__(self, pos):
+        raise NotImplementedError("SQLiteIndexMap is read-only")